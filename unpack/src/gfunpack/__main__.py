@@ -1,36 +1,90 @@
 import argparse
+import logging
 import os
 import pathlib
 
-from gfunpack import audio, backgrounds, chapters, characters, mapper, prefabs, stories
+from gfunpack import audio, backgrounds, bundles, chapters, characters, mapper, packs, pipeline, prefabs, stories
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument('dir')
-parser.add_argument('-o', '--output', required=True)
-parser.add_argument('--no-clean', action='store_true')
-args = parser.parse_args()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dir')
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('--no-clean', action='store_true')
+    parser.add_argument('--serial', action='store_true', help='run the stages one after another')
+    parser.add_argument('--bundle-cache-mb', type=int, default=1024, help='size limit of parsed bundles kept in memory')
+    parser.add_argument('--max-memory-mb', type=int, default=None,
+                        help='budget for decoded character textures held in memory at once, '
+                             'not counting the parsed bundles they are read from')
+    parser.add_argument('--story-ir', action='store_true', help='also write the JSON IR of every story')
+    parser.add_argument('--search-index', action='store_true', help='also build a full-text index of the stories')
+    parser.add_argument('--pack-stories', action='store_true', help='also pack the stories of every chapter')
+    parser.add_argument('-j', '--concurrency', type=int, default=os.cpu_count() or 2,
+                        help='worker threads/processes per stage')
+    args = parser.parse_args()
 
-cpus = os.cpu_count() or 2
+    # stage timings and memory reports are logged at INFO
+    logging.basicConfig(level=logging.INFO, format='%(name)s: %(message)s')
 
-downloaded = args.dir
-destination = pathlib.Path(args.output)
+    cpus = args.concurrency
 
-images = destination.joinpath('images')
-bg = backgrounds.BackgroundCollection(downloaded, str(images), pngquant=True, concurrency=cpus)
-bg.save()
+    bundles.cache.max_bytes = args.bundle_cache_mb << 20
 
-sprite_indices = prefabs.Prefabs(downloaded)
-chars = characters.CharacterCollection(downloaded, str(images), sprite_indices, pngquant=True, concurrency=cpus)
-chars.extract()
+    downloaded = args.dir
+    destination = pathlib.Path(args.output)
 
-character_mapper = mapper.Mapper(sprite_indices, chars)
-character_mapper.write_indices()
+    images = destination.joinpath('images')
 
-bgm = audio.BGM(downloaded, str(destination.joinpath('audio')), concurrency=cpus, clean=not args.no_clean)
-bgm.save()
+    def extract_backgrounds(_):
+        bg = backgrounds.BackgroundCollection(downloaded, str(images), pngquant=True, concurrency=cpus)
+        bg.save()
 
-ss = stories.Stories(downloaded, str(destination.joinpath('stories')))
-ss.save()
-cs = chapters.Chapters(ss)
-cs.save()
\ No newline at end of file
+    def load_prefabs(_):
+        return {'prefabs': prefabs.Prefabs(downloaded)}
+
+    def extract_characters(artifacts):
+        chars = characters.CharacterCollection(downloaded, str(images), artifacts['prefabs'],
+                                               pngquant=True, concurrency=cpus, max_memory_mb=args.max_memory_mb)
+        chars.extract()
+        return {'characters': chars}
+
+    def map_characters(artifacts):
+        character_mapper = mapper.Mapper(artifacts['prefabs'], artifacts['characters'])
+        character_mapper.write_indices()
+
+    def extract_audio(_):
+        bgm = audio.BGM(downloaded, str(destination.joinpath('audio')), concurrency=cpus, clean=not args.no_clean)
+        bgm.save()
+
+    def extract_stories(_):
+        ss = stories.Stories(downloaded, str(destination.joinpath('stories')), concurrency=cpus,
+                             ir=args.story_ir, searchable=args.search_index)
+        ss.save()
+        return {'stories': ss}
+
+    def categorize_chapters(artifacts):
+        cs = chapters.Chapters(artifacts['stories'])
+        cs.save()
+
+    def pack_stories(_):
+        story_packs = packs.StoryPacks(str(destination.joinpath('stories')), concurrency=cpus)
+        story_packs.save()
+
+    stages = pipeline.Pipeline([
+        pipeline.Stage('backgrounds', extract_backgrounds, outputs=('backgrounds.json',)),
+        pipeline.Stage('prefabs', load_prefabs, outputs=('prefabs',)),
+        pipeline.Stage('characters', extract_characters, inputs=('prefabs',), outputs=('characters',)),
+        pipeline.Stage('mapper', map_characters, inputs=('prefabs', 'characters'), outputs=('characters.json',)),
+        pipeline.Stage('audio', extract_audio, outputs=('audio.json',)),
+        pipeline.Stage('stories', extract_stories,
+                       inputs=('audio.json', 'backgrounds.json', 'characters.json'), outputs=('stories',)),
+        pipeline.Stage('chapters', categorize_chapters, inputs=('stories',), outputs=('chapters.json',)),
+    ] + ([
+        pipeline.Stage('packs', pack_stories, inputs=('chapters.json',), outputs=('packs.json',)),
+    ] if args.pack_stories else []))
+    stages.run(1 if args.serial else None)
+
+
+if __name__ == '__main__':
+    # worker processes (spawned on Windows) re-import this module
+    main()
@@ -1,14 +1,20 @@
+import hashlib
 import json
 import logging
+import os
 import pathlib
+import re
 import shutil
 import subprocess
+import tempfile
 import threading
+import typing
+import wave
 import zipfile
 
 import tqdm
 
-from gfunpack import utils
+from gfunpack import utils, workers
 
 _logger = logging.getLogger('gfunpack.utils')
 _info = _logger.info
@@ -51,72 +57,378 @@ def _test_ffmpeg():
         raise FileNotFoundError('ffmpeg is required to transcode audio files')
 
 
-def _transcode_files(files: list[pathlib.Path], force: bool, concurrency: int, clean: bool,
-                     batch_size: int = -1, bar: tqdm.tqdm | None = None):
-    semaphore = threading.Semaphore(concurrency)
-    def transcode(file: pathlib.Path, output: pathlib.Path):
-        nonlocal clean, force, semaphore
-        if force or not output.is_file():
-            subprocess.run([
-                'ffmpeg',
-                '-hide_banner',
-                '-loglevel',
-                'error',
-                '-i',
-                file,
-                output,
-            ]).check_returncode()
-        if clean:
-            file.unlink()
-        semaphore.release()
-
-    converted: dict[str, pathlib.Path] = {}
-    for file in files:
-        semaphore.acquire()
-        output = file.with_suffix('.m4a')
-        threading.Thread(target=transcode, args=(file, output)).start()
-        converted[file.stem] = output
-        if bar:
-            if batch_size == -1 or batch_size == len(files):
-                bar.update()
-            else:
-                bar.set_description(f'{file.stem}')
+_loudness_pattern = re.compile(r'^\s*I:\s*(\S+) LUFS', re.MULTILINE)
+
+# `ebur128` only takes 48 kHz samples, so the loudness is measured on a resampled copy sent to a null output
+# and the encoded stream keeps its own samples
+_loudness_filter = '[0:a]asplit[a][m];[m]aresample=48000,ebur128=framelog=verbose[loudness]'
+
+
+def _ffmpeg_args(input: list, output: pathlib.Path):
+    return [
+        'ffmpeg',
+        '-hide_banner',
+        '-nostats',
+        '-loglevel',
+        'info',
+        '-y',
+        *input,
+        '-filter_complex',
+        _loudness_filter,
+        '-map',
+        '[a]',
+        output,
+        '-map',
+        '[loudness]',
+        '-f',
+        'null',
+        '-',
+    ]
+
+
+def _parse_loudness(log: str):
+    matches = _loudness_pattern.findall(log)
+    try:
+        return float(matches[-1]) if len(matches) > 0 else None
+    except ValueError:
+        # -inf for silence
+        return None
+
+
+def _run_ffmpeg(input: list, output: pathlib.Path):
+    """
+    Transcodes the audio and returns its integrated loudness (LUFS), measured by `ebur128` on a side branch.
+    """
+    args = _ffmpeg_args(input, output)
+    result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    log = result.stderr.decode('utf-8', errors='replace')
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, args, stderr=log)
+    return _parse_loudness(log)
 
-    if bar and batch_size != -1 and batch_size != len(files):
-        bar.update(batch_size)
 
-    for _ in range(concurrency):
-        semaphore.acquire()
-    return converted
+def _wav_duration(wav: pathlib.Path):
+    try:
+        with wave.open(str(wav)) as f:
+            return f.getnframes() / f.getframerate()
+    except (wave.Error, EOFError):
+        return None
+
+
+def _transcode(file: pathlib.Path, output: pathlib.Path, force: bool, clean: bool):
+    loudness = None
+    if force or not output.is_file():
+        loudness = _run_ffmpeg(['-i', file], output)
+    if clean:
+        file.unlink()
+    return loudness
 
 
 def _extract_acb_to_wav(dat: pathlib.Path, destination: pathlib.Path,
-                        semaphore: threading.Semaphore | None = None,
                         force: bool = False,
                         clean: bool = True):
+    """
+    Decodes every subsong of a zipped ACB into its own directory under `destination` and returns the WAV files.
+    """
+    acb_audios = _extract_zip(dat, destination, force=force)
+    assert len(acb_audios) <= 1
+    if len(acb_audios) == 0:
+        return []
+    acb = acb_audios[0]
+    assert acb.suffix == '.bytes'
+    acb = acb.rename(acb.with_suffix(''))
+    # separate directories keep concurrently decoded ACBs apart
+    wav_directory = utils.check_directory(destination.joinpath('.wav', acb.stem), create=True)
+    subprocess.run([
+        'vgmstream-cli',
+        acb,
+        '-o',
+        wav_directory.joinpath('?n.wav'),
+        '-S',
+        '0',
+    ], stdout=subprocess.DEVNULL).check_returncode()
+    if clean:
+        acb.unlink()
+    return list(wav_directory.glob('*.wav'))
+
+
+class _DiskBudget:
+    """
+    Bytes of intermediate files on disk. Once above the budget, new jobs wait for transcoding to clean up.
+    """
+    used: int
+
+    max_bytes: int | None
+
+    def __init__(self, max_bytes: int | None) -> None:
+        self.used = 0
+        self.max_bytes = max_bytes
+        self._condition = threading.Condition()
+
+    def wait(self):
+        with self._condition:
+            while self.max_bytes is not None and self.used > self.max_bytes:
+                self._condition.wait()
+
+    def add(self, size: int):
+        with self._condition:
+            self.used += size
+
+    def release(self, size: int):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+def _default_staging_directory():
+    # a tmpfs keeps staged ACB files off the disk
+    shm = pathlib.Path('/dev/shm')
+    return str(shm) if shm.is_dir() and os.access(shm, os.W_OK) else None
+
+
+def _parse_vgmstream_metadata(output: str):
+    metadata: dict[str, str] = {}
+    for line in output.splitlines():
+        if ':' in line:
+            key, value = line.split(':', 1)
+            metadata.setdefault(key.strip().lower(), value.strip())
+    return metadata
+
+
+def _parse_samples(value: str | None):
+    # e.g. "12345 samples (0:00.280 seconds)"
+    if value is None:
+        return None
     try:
-        acb_audios = _extract_zip(dat, destination, force=force)
-        assert len(acb_audios) <= 1
-        if len(acb_audios) == 1:
-            acb = acb_audios[0]
-            assert acb.suffix == '.bytes'
-            acb = acb.rename(acb.with_suffix(''))
-            subprocess.run([
-                'vgmstream-cli',
-                acb,
-                '-o',
-                destination.joinpath('?n.wav'),
-                '-S',
-                '0',
-            ], stdout=subprocess.DEVNULL).check_returncode()
-            if clean:
-                acb.unlink()
-        else:
-            acb = None
-        return acb
+        return int(value.split()[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _loop_points(metadata: dict[str, str]):
+    """
+    Returns the loop start and end in seconds, if vgmstream reports any.
+    """
+    start = _parse_samples(metadata.get('loop start'))
+    end = _parse_samples(metadata.get('loop end'))
+    rate = _parse_samples(metadata.get('sample rate'))
+    if start is None or end is None or not rate:
+        return None
+    return (start / rate, end / rate)
+
+
+def _subsong_metadata(acb: pathlib.Path, subsong: int):
+    return _parse_vgmstream_metadata(subprocess.check_output(
+        ['vgmstream-cli', '-m', '-s', str(subsong), acb],
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+    ))
+
+
+def _digest_file(path: pathlib.Path):
+    h = hashlib.blake2b(digest_size=16)
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _decode_subsong(acb: pathlib.Path, subsong: int, wav: pathlib.Path):
+    """
+    Decodes a subsong into a WAV file, hashing the data on its way, and returns the hash.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    args = ['vgmstream-cli', '-p', '-s', str(subsong), acb]
+    with wav.open('wb') as f, subprocess.Popen(args, stdout=subprocess.PIPE) as decoder:
+        source = typing.cast(typing.IO[bytes], decoder.stdout)
+        for chunk in iter(lambda: source.read(1 << 16), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    if decoder.returncode != 0:
+        raise subprocess.CalledProcessError(decoder.returncode, args)
+    return digest.hexdigest()
+
+
+class _AudioStore:
+    """
+    Transcoded audio named by the hash of the decoded WAV data, so that identical tracks are encoded only once.
+
+    `index.json` remembers the tracks of every ACB, letting unchanged ACBs be skipped without decoding them,
+    and the metadata of every stored track.
+    """
+    directory: pathlib.Path
+
+    force: bool
+
+    index: dict[str, dict[str, typing.Any]]
+
+    tracks: dict[str, dict[str, typing.Any]]
+    """duration, loudness and loop points by hash"""
+
+    def __init__(self, directory: pathlib.Path, force: bool = False) -> None:
+        self.directory = utils.check_directory(directory, create=True)
+        self.force = force
+        index = self.directory.joinpath('index.json')
+        content = json.loads(index.read_text()) if index.is_file() and not force else {}
+        self.index = content.get('acb', {})
+        self.tracks = content.get('tracks', {})
+        self._claimed: set[str] = set()
+        self._lock = threading.Lock()
+
+    def path(self, digest: str):
+        return self.directory.joinpath(f'{digest}.m4a')
+
+    def claim(self, digest: str):
+        """
+        Returns whether the caller should encode the track, i.e. it is neither stored nor being encoded.
+        """
+        with self._lock:
+            if digest in self._claimed:
+                return False
+            self._claimed.add(digest)
+            return self.force or not self.path(digest).is_file()
+
+    def cached(self, dat: pathlib.Path) -> dict[str, str] | None:
+        stat = dat.stat()
+        with self._lock:
+            entry = self.index.get(dat.name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            return None
+        tracks: dict[str, str] = entry['tracks']
+        if not all(self.path(digest).is_file() for digest in tracks.values()):
+            return None
+        return tracks
+
+    def record(self, dat: pathlib.Path, tracks: dict[str, str]):
+        stat = dat.stat()
+        with self._lock:
+            self.index[dat.name] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'tracks': tracks}
+
+    def describe(self, digest: str, duration: float | None = None, loudness: float | None = None,
+                 loop: tuple[float, float] | None = None):
+        """
+        Records what is known of a track, keeping earlier values for what is not.
+        """
+        metadata: dict[str, typing.Any] = {}
+        if duration is not None:
+            metadata['duration'] = round(duration, 3)
+        if loudness is not None:
+            metadata['loudness'] = round(loudness, 1)
+        if loop is not None:
+            metadata['loop'] = [round(loop[0], 3), round(loop[1], 3)]
+        with self._lock:
+            self.tracks.setdefault(digest, {}).update(metadata)
+
+    def prune(self, names: typing.Iterable[str]):
+        """
+        Forgets ACBs other than `names` and deletes stored tracks (and partial encodes) none of them refer to.
+        """
+        names = set(names)
+        with self._lock:
+            self.index = {name: entry for name, entry in self.index.items() if name in names}
+            digests = set(digest for entry in self.index.values() for digest in entry['tracks'].values())
+            self.tracks = {digest: metadata for digest, metadata in self.tracks.items() if digest in digests}
+        for file in self.directory.glob('*.m4a'):
+            if file.stem not in digests:
+                _info('removing unreferenced %s', file.name)
+                file.unlink(missing_ok=True)
+
+    def save(self):
+        with self._lock:
+            content = json.dumps({'acb': self.index, 'tracks': self.tracks}, indent=2, ensure_ascii=False)
+        self.directory.joinpath('index.json').write_text(content)
+
+
+class _StagedAcb:
+    """
+    A zipped ACB copied out to a temporary directory for vgmstream, shared by the jobs of its subsongs,
+    which decode their WAV data next to it.
+
+    Every job holds a reference, and the directory is removed when the last one is released.
+    """
+    dat: pathlib.Path
+
+    acb: pathlib.Path | None
+    """`None` for empty archives"""
+
+    size: int
+
+    tracks: dict[int, tuple[str, str]]
+    """`(stream name, hash)` by subsong"""
+
+    failed: bool
+
+    def __init__(self, dat: pathlib.Path, staging: str | None = None) -> None:
+        self.dat = dat
+        self.acb = None
+        self.size = 0
+        self.tracks = {}
+        self.failed = False
+        self._references = 1
+        self._lock = threading.Lock()
+        self._directory = tempfile.TemporaryDirectory(dir=staging)
+        with zipfile.ZipFile(dat) as z:
+            assert len(z.filelist) <= 1
+            if len(z.filelist) == 1:
+                file = z.filelist[0]
+                # *.acb.bytes -> *.acb
+                self.acb = pathlib.Path(self._directory.name).joinpath(
+                    pathlib.PurePath(file.filename).with_suffix('').name)
+                with z.open(file) as source, self.acb.open('wb') as staged:
+                    shutil.copyfileobj(source, staged)
+                self.size = self.acb.stat().st_size
+
+    def acquire(self):
+        with self._lock:
+            self._references += 1
+
+    def release(self, failed: bool = False):
+        """
+        Returns whether this was the last reference, in which case the staged ACB is removed.
+        """
+        with self._lock:
+            self.failed = self.failed or failed
+            self._references -= 1
+            last = self._references == 0
+        if last:
+            self._directory.cleanup()
+        return last
+
+    def add(self, subsong: int, name: str, digest: str):
+        with self._lock:
+            self.tracks[subsong] = (name, digest)
+
+    def ordered_tracks(self):
+        return dict(self.tracks[subsong] for subsong in sorted(self.tracks))
+
+
+def _convert_subsong(acb: pathlib.Path, subsong: int, metadata: dict[str, str] | None, store: _AudioStore):
+    """
+    Converts a subsong into the store and returns its stream name (matching the `?n` naming of vgmstream) and hash.
+
+    The subsong is decoded next to the staged ACB (a tmpfs by default) and hashed on the way,
+    so that it is encoded only if no identical track is stored or being encoded.
+    """
+    metadata = _subsong_metadata(acb, subsong) if metadata is None else metadata
+    name = metadata.get('stream name') or acb.stem
+    wav = acb.with_name(f'{acb.stem}-{subsong}.wav')
+    loudness = None
+    try:
+        digest = _decode_subsong(acb, subsong, wav)
+        duration = _wav_duration(wav)
+        if store.claim(digest):
+            # an interrupted run leaves no truncated track behind
+            partial = store.directory.joinpath(f'.{digest}.part.m4a')
+            try:
+                loudness = _run_ffmpeg(['-i', wav], partial)
+                os.replace(partial, store.path(digest))
+            finally:
+                partial.unlink(missing_ok=True)
     finally:
-        if semaphore is not None:
-            semaphore.release()
+        wav.unlink(missing_ok=True)
+    store.describe(digest, duration, loudness, _loop_points(metadata))
+    return name, digest
 
 
 class BGM:
@@ -124,7 +436,7 @@ class BGM:
 
     destination: pathlib.Path
 
-    se_destination: pathlib.Path
+    store: _AudioStore
 
     resource_files: list[pathlib.Path]
 
@@ -138,31 +450,36 @@ class BGM:
 
     clean: bool
 
+    streaming: bool
+
+    staging: str | None
+
+    disk_budget_mb: int | None
+
     def __init__(self, directory: str, destination: str,
-                 force: bool = False, concurrency: int = 8, clean: bool = True) -> None:
+                 force: bool = False, concurrency: int = 8, clean: bool = True,
+                 streaming: bool = True, staging: str | None = None, disk_budget_mb: int | None = 2048) -> None:
         self.directory = utils.check_directory(directory)
-        self.destination = utils.check_directory(pathlib.Path(destination).joinpath('bgm'), create=True)
-        self.se_destination = utils.check_directory(pathlib.Path(destination).joinpath('se'), create=True)
+        self.destination = utils.check_directory(destination, create=True)
+        self.store = _AudioStore(self.destination.joinpath('store'), force)
         self.force = force
         self.concurrency = concurrency
         self.clean = clean
+        self.streaming = streaming
+        self.staging = _default_staging_directory() if staging is None else staging
+        self.disk_budget_mb = disk_budget_mb
         self.resource_files = list(f for f in self.directory.glob('*.acb.dat') if f.name != 'AVG.acb.dat')
         self.se_resource_file = self.directory.joinpath('AVG.acb.dat')
         _test_ffmpeg()
         self.extracted = self.extract_and_convert()
 
-    def extract_all(self, resource_files: list[pathlib.Path]):
-        _test_vgmstream()
-        semaphore = threading.Semaphore(self.concurrency)
-        for file in resource_files:
-            semaphore.acquire()
-            threading.Thread(
-                target=_extract_acb_to_wav,
-                args=(file, self.destination, semaphore, self.force, self.clean),
-            ).start()
-        for _ in range(self.concurrency):
-            semaphore.acquire()
-        return list(self.destination.glob('*.wav'))
+    def _jobs(self):
+        """
+        Every ACB, longest first by compressed size so that no long track is left to run alone at the end.
+        """
+        jobs = self.resource_files + [self.se_resource_file]
+        jobs.sort(key=lambda file: file.stat().st_size, reverse=True)
+        return jobs
 
     def _get_audio_template(self):
         content = utils.read_text_asset(self.directory.joinpath('asset_textes.ab'), 'assets/resources/textdata/audiotemplate.txt')
@@ -187,59 +504,180 @@ class BGM:
             mapping[name] = file
         return mapping
 
+    def stream_all(self):
+        """
+        Converts every subsong by piping vgmstream into ffmpeg, so that no WAV file is written.
+
+        ACBs are staged longest first and each of their subsongs is queued as its own job,
+        so that large banks such as the sound effects spread over every worker.
+        """
+        _test_vgmstream()
+        _info('extracting audio')
+        budget = _DiskBudget(None if self.disk_budget_mb is None else self.disk_budget_mb << 20)
+        converted: dict[pathlib.Path, dict[str, str]] = {}
+        lock = threading.Lock()
+        jobs = self._jobs()
+        bar = tqdm.tqdm(total=len(jobs))
+
+        def finish(staged: _StagedAcb, failed: bool):
+            if not staged.release(failed):
+                return
+            budget.release(staged.size)
+            if not staged.failed:
+                tracks = staged.ordered_tracks()
+                self.store.record(staged.dat, tracks)
+                with lock:
+                    converted[staged.dat] = tracks
+            bar.update()
+
+        with workers.Workers(self.concurrency, 'ffmpeg', max_in_flight=self.concurrency * 4) as converters:
+
+            def convert(staged: _StagedAcb, subsong: int, metadata: dict[str, str] | None):
+                assert staged.acb is not None
+                staged.add(subsong, *_convert_subsong(staged.acb, subsong, metadata, self.store))
+
+            def stage(file: pathlib.Path):
+                tracks = self.store.cached(file)
+                if tracks is not None:
+                    with lock:
+                        converted[file] = tracks
+                    bar.update()
+                    return
+                budget.wait()
+                staged = _StagedAcb(file, self.staging)
+                budget.add(staged.size)
+                failed = True
+                try:
+                    if staged.acb is not None:
+                        first = _subsong_metadata(staged.acb, 1)
+                        for subsong in range(1, int(first.get('stream count', '1')) + 1):
+                            staged.acquire()
+                            try:
+                                future = converters.submit(convert, staged, subsong, first if subsong == 1 else None,
+                                                           label=f'{file.name}#{subsong}')
+                            except BaseException:
+                                finish(staged, True)
+                                raise
+                            # also called for cancelled jobs, which would otherwise keep the ACB staged forever
+                            future.add_done_callback(
+                                lambda f, staged=staged: finish(staged, f.cancelled() or f.exception() is not None))
+                    failed = False
+                finally:
+                    finish(staged, failed)
+
+            with workers.Workers(self.concurrency, 'vgmstream', max_in_flight=len(jobs)) as stagers:
+                for file in jobs:
+                    stagers.submit(stage, file, label=file.name)
+        bar.close()
+        files: dict[str, pathlib.Path] = {}
+        for file in jobs:
+            files.update((name, self.store.path(digest)) for name, digest in converted[file].items())
+        return files
+
     def extract_and_convert(self):
-        _info('extracting se audio')
-        _extract_acb_to_wav(self.se_resource_file, self.se_destination, None, self.force, self.clean)
-        files = _transcode_files(
-            list(self.se_destination.glob('*.wav')),
-            self.force,
-            self.concurrency,
-            self.clean,
-        )
-        _info('extracting bgm audio')
-        bar = tqdm.tqdm(total=len(self.resource_files))
-        batch_count = min(self.concurrency * 8, 32) if self.clean else len(self.resource_files)
-        for i in range(0, len(self.resource_files), batch_count):
-            batch = self.resource_files[i: i + batch_count]
-            files.update(_transcode_files(
-                self.extract_all(batch),
-                self.force,
-                self.concurrency,
-                self.clean,
-                len(batch),
-                bar,
-            ))
+        if self.streaming:
+            files = self.stream_all()
+        else:
+            files = self._extract_and_transcode()
+        self.store.prune(file.name for file in self._jobs())
+        self.store.save()
+        # files of the layout before the store, which a restored output directory may still contain
+        for legacy in ('bgm', 'se'):
+            shutil.rmtree(self.destination.joinpath(legacy), ignore_errors=True)
+        return self._map_files(files)
+
+    def _extract_and_transcode(self):
+        """
+        Extracts WAV files and transcodes each one as soon as its ACB is decoded.
+
+        Decoding waits while the WAV files not yet transcoded exceed the disk budget (unless they are kept anyway).
+        """
+        _test_vgmstream()
+        _info('extracting audio')
+        budget = _DiskBudget(None if not self.clean or self.disk_budget_mb is None else self.disk_budget_mb << 20)
+        files: dict[str, pathlib.Path] = {}
+        lock = threading.Lock()
+        jobs = self._jobs()
+        bar = tqdm.tqdm(total=len(jobs))
+        with workers.Workers(self.concurrency, 'ffmpeg', max_in_flight=self.concurrency * 4) as transcoders:
+
+            def transcode(wav: pathlib.Path, digest: str):
+                duration = _wav_duration(wav)
+                loudness = _transcode(wav, self.store.path(digest), True, self.clean)
+                self.store.describe(digest, duration, loudness)
+
+            def extract(file: pathlib.Path):
+                tracks = self.store.cached(file)
+                if tracks is None:
+                    budget.wait()
+                    tracks = {}
+                    for wav in _extract_acb_to_wav(file, self.store.directory, True, self.clean):
+                        digest = _digest_file(wav)
+                        tracks[wav.stem] = digest
+                        if not self.store.claim(digest):
+                            if self.clean:
+                                wav.unlink()
+                            continue
+                        size = wav.stat().st_size
+                        future = transcoders.submit(transcode, wav, digest, label=wav.stem)
+                        budget.add(size)
+                        # also called for cancelled transcodes, which would otherwise hold the budget forever
+                        future.add_done_callback(lambda _, size=size: budget.release(size))
+                    self.store.record(file, tracks)
+                with lock:
+                    files.update((name, self.store.path(digest)) for name, digest in tracks.items())
+
+            with workers.Workers(self.concurrency, 'vgmstream', max_in_flight=len(jobs)) as extractors:
+                for file in jobs:
+                    extractors.submit(extract, file, label=file.name).add_done_callback(lambda _: bar.update())
         bar.close()
-        files.update((existing.stem, existing) for existing in self.destination.glob('*.m4a'))
-        files.update((existing.stem, existing) for existing in self.se_destination.glob('*.m4a'))
+        if self.clean:
+            shutil.rmtree(self.store.directory.joinpath('.wav'), ignore_errors=True)
+        return files
 
+    def _map_files(self, files: dict[str, pathlib.Path]):
         for audio_name, file in [item for item in files.items() if ';' in item[0]]:
-            audio_names = [name.strip() for name in audio_name.split(';')]
-            for name in audio_names:
-                f = file.with_stem(name + '.m4a')
-                shutil.copyfile(file, f)
-                files[name] = f
+            # aliases share the stored file
+            for name in (name.strip() for name in audio_name.split(';')):
+                files[name] = file
             files.pop(audio_name)
-            file.unlink()
 
         name_mapping = self._get_audio_template()
         mapping: dict[str, pathlib.Path] = {}
+        # stored files are shared by identical tracks, so track the names used rather than the files
+        mapped_names: set[str] = set()
         for name, audio_name in name_mapping.items():
             if audio_name in files:
-                mapping[name] = files[audio_name].relative_to(self.destination.parent)
+                mapping[name] = files[audio_name].relative_to(self.destination)
+                mapped_names.add(audio_name)
             elif name in files:
-                mapping[name] = files[name].relative_to(self.destination.parent)
+                mapping[name] = files[name].relative_to(self.destination)
+                mapped_names.add(name)
             else:
                 _warning('audio identifier %s not found', name)
-        mapped_files = set(mapping.values())
         for audio_name, file in files.items():
-            path = file.relative_to(self.destination.parent)
-            if path not in mapped_files:
-                mapping[audio_name] = path
+            if audio_name not in mapped_names:
+                mapping[audio_name] = file.relative_to(self.destination)
         return mapping
 
     def save(self):
-        path = self.destination.parent.joinpath('audio.json')
+        path = self.destination.joinpath('audio.json')
         with path.open('w') as f:
             f.write(json.dumps(dict((k, str(v)) for k, v in self.extracted.items()), indent=2, ensure_ascii=False))
+        self.save_metadata()
+        return path
+
+    def save_metadata(self):
+        """
+        Writes `tracks.json`, the duration, loudness and loop points of each file in `audio.json`,
+        so that players need not fetch a file to learn about it.
+        """
+        metadata: dict[str, dict[str, typing.Any]] = {}
+        for file in set(self.extracted.values()):
+            track = self.store.tracks.get(file.stem)
+            if track:
+                metadata[str(file)] = track
+        path = self.destination.joinpath('tracks.json')
+        with path.open('w') as f:
+            f.write(json.dumps(metadata, separators=(',', ':'), sort_keys=True, ensure_ascii=False))
         return path
\ No newline at end of file
@@ -2,14 +2,12 @@ import json
 import logging
 import pathlib
 import re
-import threading
 import typing
 
 import tqdm
-import UnityPy
 from UnityPy.classes import Sprite, TextAsset, Texture2D
 
-from gfunpack import utils
+from gfunpack import bundles, utils, workers
 
 _logger = logging.getLogger('gfunpack.utils')
 _warning = _logger.warning
@@ -30,20 +28,23 @@ class BackgroundCollection:
 
     pngquant: bool
 
+    quantization: str | None
+
+    _pngquant_batch: utils.PngquantBatch | None
+
     force: bool
 
     concurrency: int
 
-    _semaphore: threading.Semaphore
-
     def __init__(self, directory: str, destination: str, pngquant: bool = False, force: bool = False, concurrency: int = 8) -> None:
         self.directory = utils.check_directory(directory)
         # Основная директория для фонов
         self.destination = utils.check_directory(pathlib.Path(destination).joinpath('background'), create=True)
-        self.pngquant = utils.test_pngquant(pngquant)
+        self.quantization = utils.quantization_backend(pngquant)
+        self.pngquant = self.quantization is not None
+        self._pngquant_batch = None
         self.force = force
         self.concurrency = concurrency
-        self._semaphore = threading.Semaphore(concurrency)
         self.profile_asset = self.directory.joinpath('asset_textavg.ab')
         self.resource_files = list(self.directory.glob('resource_avgtexture*.ab'))
         self.extracted = self.extract()
@@ -52,47 +53,45 @@ class BackgroundCollection:
         content = utils.read_text_asset(self.profile_asset, 'assets/resources/dabao/avgtxt/profiles.txt')
         return [l.strip() for l in content.split('\n')]
 
-    def _save_image(self, extracted: dict[str, pathlib.Path], name: str, image: Sprite | Texture2D):
+    def _save_image(self, name: str, image: Sprite | Texture2D):
         image_path = self.destination.joinpath(f'{name}.png')
         if self.force or not image_path.is_file():
-            image.image.save(image_path)
-            utils.pngquant(image_path, use_pngquant=self.pngquant)
-        extracted[name] = image_path
-        self._semaphore.release()
+            utils.save_png(image.image, image_path, self.quantization, self._pngquant_batch)
+        return image_path
 
     def _extract_files(self, resources: dict[str, Sprite | Texture2D]):
-        extracted: dict[str, pathlib.Path] = {}
-        for name, image in resources.items():
-            self._semaphore.acquire()
-            threading.Thread(target=self._save_image, args=(extracted, name, image)).start()
-        for _ in range(self.concurrency):
-            self._semaphore.acquire()
-        for _ in range(self.concurrency):
-            self._semaphore.release()
-        return extracted
+        with workers.Workers(self.concurrency, 'background') as pool:
+            futures = dict(
+                (name, pool.submit(self._save_image, name, image, label=name))
+                for name, image in resources.items()
+            )
+        return dict((name, future.result()) for name, future in futures.items())
 
     def _extract_bg_pics(self):
         extracted: dict[str, pathlib.Path] = {}
-        for file in tqdm.tqdm(self.resource_files):
-            files: dict[str, Sprite | Texture2D] = {}
-            asset = UnityPy.load(str(file))
-            for o in tqdm.tqdm(asset.objects, leave=False):
-                if o.container is None:
-                    continue
-                if o.type.name != 'Sprite' and o.type.name != 'Texture2D':
-                    continue
-                match = _avgtexture_regex.match(o.container)
-                if match is None:
-                    continue
-                name = match.group(1).lower()
-                data = typing.cast(Sprite | Texture2D, o.read())
-                if name not in files:
-                    files[name] = data
-                else:
-                    # prioritize Texture2D assets
-                    if files[name].type.name == 'Sprite':
+        with utils.pngquant_batch(self.quantization, self.concurrency) as self._pngquant_batch:
+            for file in tqdm.tqdm(self.resource_files):
+                files: dict[str, Sprite | Texture2D] = {}
+                # each bundle is read once, so keep it out of the shared cache
+                asset = bundles.Bundle(file)
+                for o in tqdm.tqdm(asset.objects, leave=False):
+                    if o.container is None:
+                        continue
+                    if o.type.name != 'Sprite' and o.type.name != 'Texture2D':
+                        continue
+                    match = _avgtexture_regex.match(o.container)
+                    if match is None:
+                        continue
+                    name = match.group(1).lower()
+                    data = typing.cast(Sprite | Texture2D, asset.read(o))
+                    if name not in files:
                         files[name] = data
-            extracted.update(self._extract_files(files))
+                    else:
+                        # prioritize Texture2D assets
+                        if files[name].type.name == 'Sprite':
+                            files[name] = data
+                extracted.update(self._extract_files(files))
+        self._pngquant_batch = None
         return extracted
 
     def extract(self):
@@ -0,0 +1,238 @@
+import collections
+import contextlib
+import hashlib
+import pathlib
+import struct
+import threading
+import typing
+
+import UnityPy
+from UnityPy.files import ObjectReader
+from UnityPy.helpers.TypeTreeNode import TypeTreeNode
+
+_blocks_info_at_the_end = 0x80
+
+
+def _read_cstring(data: bytes, start: int):
+    end = data.index(b'\0', start)
+    return data[start:end], end + 1
+
+
+def fingerprint(path: pathlib.Path) -> str:
+    """
+    Hashes the header and the (compressed) blocks info of a UnityFS bundle.
+
+    The blocks info lists the sizes of every compressed block and the directory of the bundle,
+    so it changes with the content without the whole file being read.
+    Other formats are hashed in full.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with path.open('rb') as f:
+        head = f.read(4096)
+        try:
+            signature, i = _read_cstring(head, 0)
+            if signature != b'UnityFS':
+                raise ValueError(signature)
+            i += 4  # format version
+            _, i = _read_cstring(head, i)  # player version
+            _, i = _read_cstring(head, i)  # engine version
+            size, compressed, _, flags = struct.unpack_from('>qIII', head, i)
+            i += 20
+        except (ValueError, struct.error):
+            # not a UnityFS bundle, or one truncated within its header
+            f.seek(0)
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+            return h.hexdigest()
+        h.update(head[:i])
+        if flags & _blocks_info_at_the_end:
+            f.seek(size - compressed)
+        else:
+            # the blocks info may be aligned to 16 bytes after the header
+            f.seek(i)
+            compressed += 16
+        h.update(f.read(compressed))
+    return h.hexdigest()
+
+
+_peek_nodes: dict[tuple[int, tuple[str, ...]], tuple[TypeTreeNode, TypeTreeNode | None]] = {}
+_peek_lock = threading.Lock()
+
+
+def _get_peek_node(node: TypeTreeNode, fields: tuple[str, ...]):
+    key = (id(node), fields)
+    with _peek_lock:
+        cached = _peek_nodes.get(key)
+        if cached is not None and cached[0] is node:
+            return cached[1]
+        names = [child.m_Name for child in node.m_Children]
+        if all(field in names for field in fields):
+            last = max(names.index(field) for field in fields)
+            peek = TypeTreeNode(node.m_Level, node.m_Type, node.m_Name, node.m_ByteSize, node.m_Version,
+                                node.m_Children[:last + 1])
+        else:
+            peek = None
+        _peek_nodes[key] = (node, peek)
+        return peek
+
+
+def peek_fields(obj: ObjectReader, fields: tuple[str, ...]) -> dict[str, typing.Any]:
+    """
+    Reads only the leading top-level typetree fields of an object, up to the last one in `fields`.
+
+    Fields serialized after those (e.g. the pixel data of a Texture2D) are never deserialized.
+    Falls back to reading the whole object if the typetree lacks any of the fields.
+    """
+    node = obj._get_typetree_node()
+    peek = _get_peek_node(node, fields)
+    if peek is None:
+        data = obj.parse_as_dict()
+    else:
+        data = obj.parse_as_dict(peek, check_read=False)
+    return dict((field, data[field]) for field in fields)
+
+
+class Bundle:
+    """
+    A parsed asset bundle with a `path_id` index over its objects.
+
+    UnityPy readers share the underlying stream, so objects should be read through `read`
+    when the bundle may be used from several threads.
+    """
+    path: pathlib.Path
+
+    environment: UnityPy.Environment
+
+    size: int
+
+    objects: list[ObjectReader]
+
+    index: dict[int, ObjectReader]
+
+    lock: threading.RLock
+
+    _containers: dict[str, ObjectReader] | None
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.size = path.stat().st_size
+        self.environment = UnityPy.load(str(path))
+        self.objects = self.environment.objects
+        self.index = dict((obj.path_id, obj) for obj in self.objects)
+        self.lock = threading.RLock()
+        self._containers = None
+
+    def get(self, path_id: int) -> ObjectReader:
+        obj = self.index.get(path_id)
+        if obj is None:
+            raise ValueError(f'no object at path_id {path_id} in {self.path}')
+        return obj
+
+    def find_container(self, container: str) -> ObjectReader:
+        if self._containers is None:
+            self._containers = {}
+            for obj in self.objects:
+                if obj.container is not None:
+                    self._containers.setdefault(obj.container, obj)
+        obj = self._containers.get(container)
+        if obj is None:
+            raise ValueError(f'no object at container {container} in {self.path}')
+        return obj
+
+    def read(self, obj: ObjectReader | int) -> typing.Any:
+        if isinstance(obj, int):
+            obj = self.get(obj)
+        with self.lock:
+            return obj.read()
+
+    def peek(self, obj: ObjectReader, fields: tuple[str, ...]) -> dict[str, typing.Any]:
+        with self.lock:
+            return peek_fields(obj, fields)
+
+
+class _Entry:
+    bundle: Bundle | None
+    loading: threading.Lock
+    references: int
+
+    def __init__(self) -> None:
+        self.bundle = None
+        self.loading = threading.Lock()
+        self.references = 0
+
+
+class BundleCache:
+    """
+    Process-wide cache of parsed bundles, evicted least-recently-used first by bundle file size.
+
+    Bundles in use (see `open`) are never evicted, so the cache may temporarily exceed `max_bytes`.
+    Parsed bundles take more memory than their (compressed) files: open bundles read only once
+    with `Bundle` directly instead.
+    """
+    max_bytes: int
+
+    loads: int
+
+    hits: int
+
+    _entries: collections.OrderedDict[pathlib.Path, _Entry]
+
+    _lock: threading.Lock
+
+    def __init__(self, max_bytes: int = 1 << 30) -> None:
+        self.max_bytes = max_bytes
+        self.loads = 0
+        self.hits = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached_bytes(self):
+        return sum(e.bundle.size for e in self._entries.values() if e.bundle is not None)
+
+    def _evict(self):
+        total = self._cached_bytes()
+        for path, entry in list(self._entries.items()):
+            if total <= self.max_bytes:
+                break
+            if entry.references > 0 or entry.bundle is None:
+                continue
+            total -= entry.bundle.size
+            self._entries.pop(path)
+
+    @contextlib.contextmanager
+    def open(self, path: pathlib.Path | str) -> typing.Iterator[Bundle]:
+        key = pathlib.Path(path).resolve()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            self._entries.move_to_end(key)
+            entry.references += 1
+        try:
+            with entry.loading:
+                if entry.bundle is None:
+                    entry.bundle = Bundle(key)
+                    self.loads += 1
+                else:
+                    self.hits += 1
+            yield entry.bundle
+        finally:
+            with self._lock:
+                entry.references -= 1
+                if entry.bundle is None and entry.references == 0:
+                    # loading failed
+                    self._entries.pop(key, None)
+                self._evict()
+
+    def clear(self):
+        with self._lock:
+            for path, entry in list(self._entries.items()):
+                if entry.references == 0:
+                    self._entries.pop(path)
+
+
+cache = BundleCache()
+
+
+def open_bundle(path: pathlib.Path | str):
+    return cache.open(path)
@@ -435,4 +435,40 @@ class Chapters:
 
         # Исправленная часть - добавлено указание кодировки
         with self.stories.destination.joinpath('chapters.json').open('w', encoding='utf-8') as f:
-            json.dump(all_chapters, f, ensure_ascii=False, indent=2)
\ No newline at end of file
+            json.dump(all_chapters, f, ensure_ascii=False, indent=2)
+        self.save_warm_sets()
+
+    def _warm_set(self, chapter: Chapter):
+        """
+        Assets to prefetch on opening a chapter: those needed before the first line of any of its stories,
+        and those shared by more than one of its stories.
+        """
+        files = list(dict.fromkeys(
+            (f if isinstance(f, str) else f[0]) for story in chapter.stories for f in story.files
+        ))
+        warm: set[str] = set()
+        seen: set[str] = set()
+        for file in files:
+            urls = set()
+            for url, line in self.stories.assets.get(file, []):
+                urls.add(url)
+                if line == 0:
+                    warm.add(url)
+            warm.update(urls & seen)
+            seen.update(urls)
+        return warm
+
+    def save_warm_sets(self):
+        """
+        Writes `warm.json`, mirroring `chapters.json` with the sorted asset ids (see `assets.json`)
+        of every chapter's warm set.
+        """
+        ids = self.stories.asset_ids()
+        warm_sets = dict(
+            (k, [sorted(ids[url] for url in self._warm_set(chapter)) for chapter in chapters])
+            for k, chapters in self.all_chapters.items()
+        )
+        path = self.stories.destination.joinpath('warm.json')
+        with path.open('w', encoding='utf-8') as f:
+            f.write(json.dumps(warm_sets, separators=(',', ':')))
+        return path
@@ -1,24 +1,19 @@
+import dataclasses
 import logging
-import os
 import pathlib
-import re
-import subprocess
 import threading
 import typing
 
 import tqdm
-import UnityPy
+from PIL import Image
 from UnityPy.classes import Sprite, Texture2D
 
-from gfunpack import database, prefabs, utils
+from gfunpack import bundles, database, prefabs, utils, workers
 
 _logger = logging.getLogger('gfunpack.character')
 _info = _logger.info
 _warning = _logger.warning
 
-_character_file_regex = re.compile('^character_(.*)\\.ab$')
-
-
 _alpha_postfixes = {
     'ar18/AR18_N_1.png': 'ar18/AR18_N_0.png',
     'ar18/AR18_N_2.png': 'ar18/AR18_N_0.png',
@@ -28,6 +23,13 @@ _alpha_postfixes = {
 }
 
 
+@dataclasses.dataclass
+class AlphaInfo:
+    transparent: bool
+    bbox: tuple[int, int, int, int] | None
+    """bounding box of the non-transparent pixels, `None` if fully transparent"""
+
+
 class CharacterCollection:
     directory: pathlib.Path
 
@@ -43,18 +45,28 @@ class CharacterCollection:
 
     pngquant: bool
 
+    quantization: str | None
+
+    _pngquant_batch: utils.PngquantBatch | None
+
     force: bool
 
     concurrency: int
 
     verbose: bool
 
-    _semaphore: threading.Semaphore
+    max_memory_mb: int | None
+    """budget for decoded textures only, not counting the parsed bundles holding them or the bundle cache"""
 
-    _i: int
+    peak_rss_mb: float | None
+    """peak memory of the whole process when extraction finished, other stages running alongside included"""
+
+    peak_rss_growth_mb: float | None
+    """how much extraction raised that peak"""
 
     def __init__(self, directory: str, destination: str, prefab_indices: prefabs.Prefabs,
-                 pngquant: bool = False, force: bool = False, concurrency=8, verbose: bool = False):
+                 pngquant: bool = False, force: bool = False, concurrency=8, verbose: bool = False,
+                 max_memory_mb: int | None = None):
         self.image_details = prefab_indices.details
         self.required_path_ids = set(
             i
@@ -67,50 +79,47 @@ class CharacterCollection:
         self.destination = utils.check_directory(destination, create=True)
         db_path = str(self.destination.parent.joinpath('image.db').resolve())
         _info('database: %s', db_path)
-        self.db = database.Database(db_path, directory)
-        self._i = 0
+        self.db = database.Database(db_path, directory, concurrency=concurrency)
 
         self.exported_images = {}
         self.character_index = {}
-        self.pngquant = utils.test_pngquant(pngquant)
+        self.quantization = utils.quantization_backend(pngquant)
+        self.pngquant = self.quantization is not None
+        self._pngquant_batch = None
         self.force = force
         self.concurrency = concurrency
         self.verbose = verbose
-        self._semaphore = threading.Semaphore(concurrency)
-        self._test_commands()
-
-    def _unique_id(self):
-        self._i += 1
-        return self._i
+        self.max_memory_mb = max_memory_mb
+        self.peak_rss_mb = None
+        self.peak_rss_growth_mb = None
 
-    def _test_commands(self) -> None:
-        try:
-            subprocess.run(['magick', '--help'], stdout=subprocess.DEVNULL).check_returncode()
-        except FileNotFoundError as e:
-            raise FileNotFoundError('imagemagick is required to merge alpha layers', e)
-
-    def _extract_pics(self, bundle: UnityPy.Environment):
+    @classmethod
+    def _inspect_alpha(cls, pics: list[pathlib.Path | Image.Image]):
         """
-        Extracts all the sprites and textures from the given bundle.
+        Checks the opacity of a batch of images (files or already decoded ones) in-process.
+
+        The bounding box of the non-transparent pixels comes from the same alpha plane.
         """
-        path_id_index: dict[int, Texture2D | Sprite] = {}
-        for obj in bundle.objects:
-            if obj.type.name != 'Sprite' and obj.type.name != 'Texture2D':
-                continue
-            if obj.path_id == 0 or obj.path_id not in self.required_path_ids:
-                continue
-            typed = typing.cast(Sprite | Texture2D, obj.read())
-            path_id_index[obj.path_id] = typed
-        return path_id_index
+        results: list[AlphaInfo] = []
+        for pic in pics:
+            opened = Image.open(pic) if isinstance(pic, pathlib.Path) else None
+            image = pic if opened is None else opened
+            try:
+                if image.mode == 'P' or 'transparency' in image.info:
+                    image = image.convert('RGBA')
+                if 'A' not in image.getbands():
+                    results.append(AlphaInfo(False, (0, 0, image.width, image.height)))
+                    continue
+                alpha = image.getchannel('A')
+                results.append(AlphaInfo(alpha.getextrema()[0] != 255, alpha.getbbox()))
+            finally:
+                if opened is not None:
+                    opened.close()
+        return results
 
     @classmethod
-    def _has_alpha_channel(cls, pics: list[pathlib.Path]):
-        output = subprocess.check_output(
-            ['magick', 'identify', '-format', '%[opaque]\\n']
-            + [pic.resolve() for pic in pics],
-            text=True,
-        )
-        return [line.lower() == 'false' for line in output.split('\n') if line != '']
+    def _has_alpha_channel(cls, pics: list[pathlib.Path | Image.Image]):
+        return [info.transparent for info in cls._inspect_alpha(pics)]
 
     def _get_image_destination(self, character: str, name: str | None = None):
         directory = self.destination.joinpath(character)
@@ -120,93 +129,116 @@ class CharacterCollection:
 
     def _merge_alpha_channel(self, directory: pathlib.Path, name: str, path_id: int, key: str,
                              sprite: Texture2D, alpha_sprite: Texture2D):
-        try:
-            directory.mkdir(parents=True, exist_ok=True)
-            image_path = directory.joinpath(f'{name}.png').resolve()
-            self.exported_images[key] = image_path
-
-            if not self.force and image_path.exists():
-                return image_path
-            i = self._unique_id()
-            sprite_path = directory.joinpath(f'{name}.sprite-{i}.png')
-            alpha_path = directory.joinpath(f'{name}.alpha-{i}.png')
-            alpha_dims_path = directory.joinpath(f'{name}.dims-{i}.png')
-            if alpha_sprite.name.endswith('_Alpha'):
-                sprite.image.save(sprite_path)
-                alpha_sprite.image.save(alpha_path)
-                self._merge_files(sprite_path, alpha_path, alpha_dims_path, image_path)
-                # remove intermediate files
-                for file in (sprite_path, alpha_path, alpha_dims_path):
-                    os.remove(file)
-            else:
-                alpha_sprite.image.save(image_path)
-                if not self._has_alpha_channel([image_path])[0]:
-                    sprite.image.save(image_path)
-                if not self._has_alpha_channel([image_path])[0]:
+        directory.mkdir(parents=True, exist_ok=True)
+        image_path = directory.joinpath(f'{name}.png').resolve()
+        self.exported_images[key] = image_path
+
+        if not self.force and image_path.exists():
+            return image_path
+        if alpha_sprite.name.endswith('_Alpha'):
+            image = self._merge_images(sprite.image, alpha_sprite.image)
+        else:
+            image = alpha_sprite.image
+            if not self._has_alpha_channel([image])[0]:
+                image = sprite.image
+                if not self._has_alpha_channel([image])[0]:
                     _warning('no alpha channel: %s', image_path)
-            utils.pngquant(image_path, use_pngquant=self.pngquant)
-        finally:
-            self._semaphore.release()
+        utils.save_png(image, image_path, self.quantization, self._pngquant_batch)
+        return image_path
 
     @classmethod
-    def _merge_files(cls, sprite_path: pathlib.Path, alpha_path: pathlib.Path,
-                     alpha_dims_path: pathlib.Path, image_path: pathlib.Path):
-        # resize to the same dimensions
-        subprocess.run([
-            'magick',
-            sprite_path,
-            '-set',
-            'option:dims',
-            '%wx%h',
-            alpha_path,
-            '-delete',
-            '0',
-            '-resize',
-            '%[dims]',
-            alpha_dims_path,
-        ]).check_returncode()
-        # copy the alpha channel
-        subprocess.run([
-            'magick',
-            sprite_path,
-            alpha_dims_path,
-            '-compose',
-            'copy-opacity',
-            '-composite',
-            image_path,
-        ]).check_returncode()
+    def _merge_images(cls, sprite: Image.Image, alpha: Image.Image) -> Image.Image:
+        """
+        Resizes the alpha texture to the sprite dimensions and copies it as the opacity of the sprite.
+
+        Like ImageMagick's ``copy-opacity``, the alpha band of the alpha texture is used if it carries
+        any transparency (e.g. ``Alpha8`` textures), and its grayscale intensity otherwise.
+        """
+        merged = sprite.convert('RGBA')
+        if alpha.mode == 'P' or 'transparency' in alpha.info:
+            # quantized textures keep their transparency in a palette
+            alpha = alpha.convert('RGBA')
+        if 'A' in alpha.getbands() and alpha.getchannel('A').getextrema()[0] != 255:
+            mask = alpha.getchannel('A')
+        else:
+            mask = alpha.convert('L')
+        if mask.size != merged.size:
+            mask = mask.resize(merged.size, Image.Resampling.BICUBIC)
+        merged.putalpha(mask)
+        return merged
 
     def read_single(self, info: database.Image):
         path = self.db.get_bundle_path(info.bundle)
-        bundle = UnityPy.load(str(path))
-        for obj in bundle.objects:
-            if obj.path_id == info.path_id:
-                return typing.cast(Texture2D | Sprite, obj.read())
-        raise ValueError(f'no object at path_id {info.path_id}')
-
-    def _try_merging_alpha(self, path_id_index: dict[int, Texture2D | Sprite], sprites: list[int]):
-        for character, details in (bar := tqdm.tqdm(self.image_details.items())):
-            bar.set_description(character)
+        with bundles.open_bundle(path) as bundle:
+            return typing.cast(Texture2D | Sprite, bundle.read(info.path_id))
+
+    def read_many(self, infos: list[database.Image]):
+        """
+        Reads the given images, loading each bundle only once.
+
+        Bundles are loaded outside the shared cache: textures keep their bundle alive anyway,
+        and it should be freed with the last of them rather than stay cached.
+        """
+        by_bundle: dict[str, list[database.Image]] = {}
+        for info in infos:
+            by_bundle.setdefault(info.bundle, []).append(info)
+        images: dict[int, Texture2D | Sprite] = {}
+        for bundle_name, bundle_infos in by_bundle.items():
+            bundle = bundles.Bundle(self.db.get_bundle_path(bundle_name))
+            for info in bundle_infos:
+                images[info.path_id] = typing.cast(Texture2D | Sprite, bundle.read(info.path_id))
+        return images
+
+    def _resolve_alpha_bases(self, sources: dict[int, database.Image]):
+        """
+        Finds the base textures of details that only have an `_Alpha` texture and adds them to the sources.
+
+        Done in one query before merging so that the merge loop never waits on the database.
+        """
+        names: set[str] = set()
+        for details in self.image_details.values():
+            for detail in details:
+                if detail.path_id in sources or detail.alpha_path_id not in sources:
+                    continue
+                alpha = sources[detail.alpha_path_id]
+                if alpha.name.endswith('_Alpha'):
+                    names.add(alpha.name[:-6])
+        if len(names) == 0:
+            return {}
+        resolved = self.db.find_by_names(sorted(names))
+        for info in resolved.values():
+            sources[info.path_id] = info
+        return resolved
+
+    def _plan_merges(self, sources: dict[int, database.Image]):
+        """
+        Picks the image and the alpha texture of every detail from the database records alone.
+
+        Returns `(character, index, path_id, alpha_path_id)` tuples grouped by the bundles of the image
+        and of the alpha texture.
+        """
+        resolved = self._resolve_alpha_bases(sources)
+        plan: list[tuple[str, int, int, int]] = []
+        for character, details in self.image_details.items():
             for i, detail in enumerate(details):
                 assert character.lower() == detail.name.lower()
                 path_id = detail.path_id
                 alpha_path_id = detail.alpha_path_id
-                if path_id not in path_id_index:
+                if path_id not in sources:
                     path_id = 0
-                if alpha_path_id not in path_id_index:
+                if alpha_path_id not in sources:
                     alpha_path_id = 0
                 if path_id == 0:
                     if alpha_path_id == 0:
                         _warning(f'no image at all: {character}: {detail}')
                         continue
-                    alpha = path_id_index[alpha_path_id]
+                    alpha = sources[alpha_path_id]
                     if alpha.name.endswith('_Alpha'):
                         name = alpha.name[:-6]
-                        info = self.db.find_by_name(name)
+                        info = resolved.get(name)
                         if info is None:
                             _warning(f'no image for _Alpha: {character}: {name} {detail}')
                             continue
-                        path_id_index[info.path_id] = self.read_single(info)
                         path_id = info.path_id
                         detail.path_id = path_id
                     else:
@@ -215,77 +247,60 @@ class CharacterCollection:
                 if alpha_path_id == 0:
                     _warning(f'no alpha channel: {character}: {detail}')
                     alpha_path_id = path_id
-                self._semaphore.acquire()
-                image = path_id_index[path_id]
-                alpha_image = path_id_index[alpha_path_id]
+                plan.append((character, i, path_id, alpha_path_id))
+        plan.sort(key=lambda item: (sources[item[2]].bundle, sources[item[3]].bundle))
+        return plan
+
+    def _try_merging_alpha(self, sources: dict[int, database.Image]):
+        plan = self._plan_merges(sources)
+        textures = _TexturePool(sources, [[path_id, alpha_path_id] for _, _, path_id, alpha_path_id in plan],
+                                self.read_many, self.max_memory_mb, lookahead=self.concurrency * 4)
+        with workers.Workers(self.concurrency, 'merge') as pool:
+            for character, i, path_id, alpha_path_id in (bar := tqdm.tqdm(plan)):
+                bar.set_description(character)
+                image, alpha_image = textures.acquire([path_id, alpha_path_id])
                 name = image.name
                 assert name is not None and name != ''
-                threading.Thread(
-                    target=self._merge_alpha_channel,
-                    args=(
-                        self._get_image_destination(character.lower()),
-                        name,
-                        path_id,
-                        f'{character}/{i}',
-                        image,
-                        alpha_image,
-                    ),
-                ).start()
-
-        for _ in range(self.concurrency):
-            self._semaphore.acquire(timeout=120/self.concurrency)
-        for _ in range(self.concurrency):
-            self._semaphore.release()
+                key = f'{character}/{i}'
+                future = pool.submit(
+                    self._merge_alpha_channel,
+                    self._get_image_destination(character.lower()),
+                    name,
+                    path_id,
+                    key,
+                    image,
+                    alpha_image,
+                    label=key,
+                )
+                # also releases the textures of merges cancelled after a failure
+                future.add_done_callback(lambda _, path_ids=[path_id, alpha_path_id]: textures.release(path_ids))
 
     def _postfix(self):
         image = self._get_image_destination('npc-sakura', 'Pic_Sakura_D.png')
         if not self._has_alpha_channel([image])[0]:
-            source = image.rename(image.with_suffix('.tmp.png'))
             # crop the image, parameters manually acquired
-            subprocess.run([
-                'magick',
-                source,
-                '-crop',
-                '809x1367+782+13',
-                image,
-            ]).check_returncode()
-            source.unlink()
+            with Image.open(image) as source:
+                cropped = source.crop((782, 13, 782 + 809, 13 + 1367))
+            cropped.save(image)
         for image_name, alpha_name in _alpha_postfixes.items():
             image = self._get_image_destination(image_name)
             alpha = self._get_image_destination(alpha_name)
-            source = image.with_suffix('.tmp.png')
-            dims = image.with_suffix('.dims.png')
-            image.rename(source)
-            self._merge_files(source, alpha, dims, image)
-            for f in [source, dims]:
-                f.unlink()
+            with Image.open(image) as source, Image.open(alpha) as alpha_source:
+                merged = self._merge_images(source, alpha_source)
+            merged.save(image)
 
     def extract(self):
         l = list(self.required_path_ids)
         images = self.db.get_by_path_ids(l)
         sprites = self.db.get_by_path_ids(l, True)
-        bundles = set(image.bundle for image in images).union(
-            set(sprite.bundle for sprite in sprites),
-        )
-        path_id_index: dict[int, Texture2D | Sprite] = {}
-        for bundle_name in (bar := tqdm.tqdm(bundles)):
-            path = self.db.get_bundle_path(bundle_name)
-            file = str(path)
-            if file.endswith('resourcefairy.ab'):
-                group = 'fairy'
-            else:
-                # Group images by character names
-                match = _character_file_regex.match(file)
-                group = bundle_name if match is None else match.group(1)
-            bar.set_description(group)
-            bundle = UnityPy.load(file)
-            extracted = self._extract_pics(bundle)
-            for path_id, img in extracted.items():
-                if path_id in path_id_index and 'avgpicprefab' in bundle_name:
-                    continue
-                path_id_index[path_id] = img
+        sources: dict[int, database.Image] = {}
+        for info in images + sprites:
+            # avgpicprefab bundles only as a fallback
+            if info.path_id in sources and 'avgpicprefab' in info.bundle:
+                continue
+            sources[info.path_id] = info
 
-        if path_id_index.keys() != self.required_path_ids:
+        if sources.keys() != self.required_path_ids:
             non_alpha_ids = set(
                 detail.path_id
                 for details in self.image_details.values()
@@ -293,6 +308,105 @@ class CharacterCollection:
                 if detail.path_id != 0
             )
             # transparency already merged into the alpha image
-            assert (self.required_path_ids - path_id_index.keys()).issubset(non_alpha_ids)
-        self._try_merging_alpha(path_id_index, [s.path_id for s in sprites])
-        self._postfix()
\ No newline at end of file
+            assert (self.required_path_ids - sources.keys()).issubset(non_alpha_ids)
+        peak_before = utils.peak_rss_mb()
+        with utils.pngquant_batch(self.quantization, self.concurrency) as self._pngquant_batch:
+            self._try_merging_alpha(sources)
+        self._pngquant_batch = None
+        self._postfix()
+        self.peak_rss_mb = utils.peak_rss_mb()
+        if self.peak_rss_mb is not None and peak_before is not None:
+            self.peak_rss_growth_mb = self.peak_rss_mb - peak_before
+            _info('process peak memory after character extraction: %.0f MiB (+%.0f MiB)',
+                  self.peak_rss_mb, self.peak_rss_growth_mb)
+
+
+class _TexturePool:
+    """
+    Textures read for pending merges, loaded a bundle at a time and dropped after their last merge.
+
+    Merges must be acquired in the order of `uses`. Opening a bundle also loads its other textures
+    first used within the next `lookahead` merges, but not those needed much later.
+
+    Memory is estimated from the decoded RGBA size. Once above the budget, loading waits for
+    running merges to release their textures.
+    """
+    sources: dict[int, database.Image]
+
+    textures: dict[int, Texture2D | Sprite]
+
+    remaining: dict[int, int]
+
+    pending: dict[str, set[int]]
+
+    first_use: dict[int, int]
+
+    position: int
+    """merges acquired so far"""
+
+    lookahead: int
+
+    loaded_bytes: int
+
+    in_flight: int
+
+    max_bytes: int | None
+
+    def __init__(self, sources: dict[int, database.Image], uses: list[list[int]],
+                 read: typing.Callable[[list[database.Image]], dict[int, Texture2D | Sprite]],
+                 max_memory_mb: int | None, lookahead: int = 16) -> None:
+        self.sources = sources
+        self.textures = {}
+        self.remaining = {}
+        self.pending = {}
+        self.first_use = {}
+        for position, path_ids in enumerate(uses):
+            for path_id in set(path_ids):
+                self.remaining[path_id] = self.remaining.get(path_id, 0) + 1
+                self.pending.setdefault(sources[path_id].bundle, set()).add(path_id)
+                self.first_use.setdefault(path_id, position)
+        self.position = 0
+        self.lookahead = lookahead
+        self.loaded_bytes = 0
+        self.in_flight = 0
+        self.max_bytes = None if max_memory_mb is None else max_memory_mb << 20
+        self._read = read
+        self._condition = threading.Condition()
+
+    def _size(self, path_id: int):
+        info = self.sources[path_id]
+        return info.width * info.height * 4
+
+    def acquire(self, path_ids: list[int]):
+        with self._condition:
+            while self.max_bytes is not None and self.loaded_bytes > self.max_bytes and self.in_flight > 0:
+                self._condition.wait()
+            missing = [path_id for path_id in path_ids if path_id not in self.textures]
+            horizon = self.position + self.lookahead
+            self.position += 1
+        for bundle in dict.fromkeys(self.sources[path_id].bundle for path_id in missing):
+            # read what is needed soon from the bundle while it is open, the rest when it is reopened
+            pending = self.pending.get(bundle, set())
+            near = set(path_id for path_id in pending if self.first_use[path_id] < horizon)
+            pending.difference_update(near)
+            if len(pending) == 0:
+                self.pending.pop(bundle, None)
+            loaded = self._read([self.sources[path_id] for path_id in near])
+            with self._condition:
+                for path_id, texture in loaded.items():
+                    if self.remaining.get(path_id, 0) > 0:
+                        self.textures[path_id] = texture
+                        self.loaded_bytes += self._size(path_id)
+        with self._condition:
+            self.in_flight += 1
+            return [self.textures[path_id] for path_id in path_ids]
+
+    def release(self, path_ids: list[int]):
+        with self._condition:
+            for path_id in set(path_ids):
+                self.remaining[path_id] -= 1
+                if self.remaining[path_id] == 0 and path_id in self.textures:
+                    self.textures.pop(path_id)
+                    self.loaded_bytes -= self._size(path_id)
+            self.in_flight -= 1
+            self._condition.notify_all()
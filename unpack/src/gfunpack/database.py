@@ -6,7 +6,9 @@ from pathlib import Path
 
 import tqdm
 import UnityPy
-from UnityPy.classes import Sprite, Texture2D
+from UnityPy.files import ObjectReader
+
+from gfunpack import bundles, workers
 
 
 _logger = logging.getLogger('gfunpack.database')
@@ -26,11 +28,55 @@ class Image:
 _image_fields = 'path_id, name, is_sprite, width, height, bundle, container'
 _image_field_placeholders = ', '.join(['?'] * len(_image_fields.split(',')))
 
+_texture_fields = ('m_Name', 'm_Width', 'm_Height')
+_sprite_fields = ('m_Name', 'm_Rect')
+
 
 def to_image(data: tuple | None):
     return None if data is None else Image(*data)
 
 
+def _read_records(bundle_name: str, objects: list[ObjectReader],
+                  peek: typing.Callable[[ObjectReader, tuple[str, ...]], dict[str, typing.Any]]) -> list[tuple]:
+    """
+    Collects image rows (in `_image_fields` order) from the objects of a bundle.
+
+    Only the fields up to the dimensions are deserialized, so the cost does not depend on the texture sizes.
+    """
+    records: list[tuple] = []
+    for obj in objects:
+        if obj.type.name == 'Texture2D':
+            fields = peek(obj, _texture_fields)
+            records.append((
+                obj.path_id,
+                fields['m_Name'],
+                0,
+                fields['m_Width'],
+                fields['m_Height'],
+                bundle_name,
+                obj.container or '',
+            ))
+        elif obj.type.name == 'Sprite':
+            fields = peek(obj, _sprite_fields)
+            rect = fields['m_Rect']
+            records.append((
+                obj.path_id,
+                fields['m_Name'],
+                1,
+                int(rect['width']),
+                int(rect['height']),
+                bundle_name,
+                obj.container or '',
+            ))
+    return records
+
+
+def _index_bundle(path: Path) -> list[tuple]:
+    # runs in worker processes, which do not share the bundle cache of the parent
+    bundle = UnityPy.load(str(path))
+    return _read_records(path.stem, bundle.objects, bundles.peek_fields)
+
+
 class Database:
     db: sqlite3.Connection
 
@@ -38,11 +84,20 @@ class Database:
 
     directory: Path
 
+    concurrency: int
+
+    changed_bundles: set[str]
+
+    removed_bundles: set[str]
+
     _initialized: bool
 
-    def __init__(self, db: str, directory: str):
+    def __init__(self, db: str, directory: str, concurrency: int = 1):
         self.bundles = list(Path(directory).glob('*.ab'))
         self.directory = Path(directory)
+        self.concurrency = concurrency
+        self.changed_bundles = set()
+        self.removed_bundles = set()
         self.db = sqlite3.connect(db)
         self._initialized = False
 
@@ -53,16 +108,47 @@ class Database:
         return self.directory.joinpath(f'{bundle}.ab')
 
     @classmethod
-    def _get_bundles(cls, cur: sqlite3.Cursor) -> list[tuple[str, int]]:
-        res = cur.execute('SELECT name, size FROM bundle')
+    def _get_bundles(cls, cur: sqlite3.Cursor) -> list[tuple[str, int, int | None, str | None]]:
+        res = cur.execute('SELECT name, size, mtime, fingerprint FROM bundle')
         return res.fetchall()
 
+    def get_changed_bundles(self) -> set[str]:
+        """
+        Names of the bundles that were added or whose content changed since the last indexing.
+        """
+        self._init()
+        return self.changed_bundles
+
+    def _index_bundles(self, paths: list[Path]) -> list[tuple]:
+        records: list[tuple] = []
+        if self.concurrency <= 1 or len(paths) <= 1:
+            # each bundle is read once, so keep it out of the shared cache
+            for path in tqdm.tqdm(paths):
+                bundle = bundles.Bundle(path)
+                records.extend(_read_records(path.stem, bundle.objects, bundle.peek))
+            return records
+        indexed = workers.process_map(_index_bundle, [(path,) for path in paths], self.concurrency,
+                                      cost=lambda item: item[0].stat().st_size)
+        for bundle_records in indexed:
+            records.extend(bundle_records)
+        return records
+
     def _init(self):
         if self._initialized:
             return
         cur = self.db.cursor()
         try:
-            cur.execute('CREATE TABLE IF NOT EXISTS bundle (name TEXT PRIMARY KEY, size INTEGER)')
+            cur.execute('CREATE TABLE IF NOT EXISTS bundle ('
+                        'name TEXT PRIMARY KEY,'
+                        'size INTEGER,'
+                        'mtime INTEGER,'
+                        'fingerprint TEXT'
+                        ')')
+            columns = set(row[1] for row in cur.execute('PRAGMA table_info(bundle)').fetchall())
+            for column, column_type in (('mtime', 'INTEGER'), ('fingerprint', 'TEXT')):
+                if column not in columns:
+                    # databases from before fingerprinting: those bundles get indexed once more
+                    cur.execute(f'ALTER TABLE bundle ADD COLUMN {column} {column_type}')
             cur.execute('CREATE TABLE IF NOT EXISTS image ('
                         'id INTEGER PRIMARY KEY,'
                         'path_id INTEGER,'
@@ -78,57 +164,42 @@ class Database:
             cur.execute('CREATE INDEX IF NOT EXISTS idx_image_name ON image (name)')
             cur.execute('CREATE INDEX IF NOT EXISTS idx_image_container ON image (container)')
 
-            db_bundles = set(self._get_bundles(cur))
-            now_bundles = set((b.stem, b.stat().st_size) for b in self.bundles)
-            removed_bundles = db_bundles - now_bundles
-            new_bundles = set(b for b, _ in now_bundles - db_bundles)
-            if len(removed_bundles) > 0:
+            db_bundles = dict((name, (size, mtime, digest)) for name, size, mtime, digest in self._get_bundles(cur))
+            changed: dict[str, tuple[int, int, str]] = {}
+            touched: list[tuple[int, str, str]] = []
+            for path in self.bundles:
+                stat = path.stat()
+                record = db_bundles.get(path.stem)
+                if record is not None and record[:2] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                digest = bundles.fingerprint(path)
+                if record is not None and (record[0], record[2]) == (stat.st_size, digest):
+                    # same content, only the modification time differs
+                    touched.append((stat.st_mtime_ns, digest, path.stem))
+                    continue
+                changed[path.stem] = (stat.st_size, stat.st_mtime_ns, digest)
+            removed_bundles = db_bundles.keys() - set(b.stem for b in self.bundles)
+            stale_bundles = removed_bundles | (changed.keys() & db_bundles.keys())
+            if len(stale_bundles) > 0:
                 cur.execute(f'''DELETE FROM bundle WHERE name IN ({
-                    ', '.join('?' * len(removed_bundles))
-                })''', [b for b, _ in removed_bundles])
+                    ', '.join('?' * len(stale_bundles))
+                })''', list(stale_bundles))
                 cur.execute('DELETE FROM image WHERE bundle NOT IN (SELECT name FROM bundle)')
 
-            new_records: list[Image] = []
-            for path in tqdm.tqdm(self.bundles):
-                if path.stem not in new_bundles:
-                    continue
-                bundle = UnityPy.load(str(path))
-                for obj in bundle.objects:
-                    if obj.type.name == 'Texture2D':
-                        image = typing.cast(Texture2D, obj.read())
-                        info = Image(
-                            image.path_id,
-                            image.name,
-                            0,
-                            image.m_Width,
-                            image.m_Height,
-                            path.stem,
-                            str(image.get('container', '')),
-                        )
-                    elif obj.type.name == 'Sprite':
-                        image = typing.cast(Sprite, obj.read())
-                        info = Image(
-                            image.path_id,
-                            image.name,
-                            1,
-                            int(image.m_Rect.width),
-                            int(image.m_Rect.height),
-                            path.stem,
-                            str(image.get('container', '')),
-                        )
-                    else:
-                        continue
-                    new_records.append(info)
-
+            new_paths = [path for path in self.bundles if path.stem in changed]
+            new_records = self._index_bundles(new_paths)
             if len(new_records) > 0:
                 cur.executemany(
                     f'INSERT INTO image ({_image_fields}) VALUES ({_image_field_placeholders})',
-                    ((r.path_id, r.name, r.is_sprite, r.width, r.height, r.bundle, r.container) for r in new_records),
+                    new_records,
                 )
             cur.executemany(
-                'INSERT INTO bundle (name, size) VALUES (?, ?)',
-                list(now_bundles - db_bundles),
+                'INSERT INTO bundle (name, size, mtime, fingerprint) VALUES (?, ?, ?, ?)',
+                [(name, *info) for name, info in changed.items()],
             )
+            cur.executemany('UPDATE bundle SET mtime = ?, fingerprint = ? WHERE name = ?', touched)
+            self.changed_bundles = set(changed.keys())
+            self.removed_bundles = removed_bundles
         finally:
             cur.close()
             self.db.commit()
@@ -173,6 +244,29 @@ class Database:
         finally:
             cur.close()
 
+    def find_by_names(self, names: list[str]) -> dict[str, Image]:
+        """
+        Batched `find_by_name`: maps each found name to its first matching texture.
+        """
+        self._init()
+        cur = self.db.cursor()
+        try:
+            found: dict[str, Image] = {}
+            for i in range(0, len(names), 1000):
+                batch = names[i : i+1000]
+                res = cur.execute(
+                    f'''SELECT {_image_fields} FROM image WHERE name IN ({
+                        ', '.join('?' * len(batch))
+                    }) AND is_sprite = 0 ORDER BY id''',
+                    batch,
+                )
+                for r in res.fetchall():
+                    image = Image(*r)
+                    found.setdefault(image.name, image)
+            return found
+        finally:
+            cur.close()
+
     def find_sprite_by_id(self, path_id: int):
         self._init()
         cur = self.db.cursor()
@@ -0,0 +1,94 @@
+import gzip
+import json
+import logging
+import pathlib
+import typing
+
+from gfunpack import utils, workers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_logger = logging.getLogger('gfunpack.packs')
+_info = _logger.info
+_warning = _logger.warning
+
+
+def _story_path(entry: str | dict[str, str]):
+    # stories.json maps names to paths, or to {"path": ..., "ir": ...} with the IR enabled
+    return entry if isinstance(entry, str) else entry['path']
+
+
+def _chapter_files(chapter: dict[str, typing.Any]):
+    files: list[str] = []
+    for story in chapter['stories']:
+        for file in story['files']:
+            name = file if isinstance(file, str) else file[0]
+            if name not in files:
+                files.append(name)
+    return files
+
+
+class StoryPacks:
+    """
+    Concatenates the stories of every chapter in `chapters.json` into one pack,
+    with `.gz` (and `.br` if `brotli` is installed) siblings.
+
+    `packs.json` mirrors `chapters.json`: for each category, a list of `[pack path, {story: [offset, length]}]`
+    per chapter, offsets being into the uncompressed pack so that single stories can be fetched with HTTP ranges.
+    """
+    directory: pathlib.Path
+
+    destination: pathlib.Path
+
+    concurrency: int
+
+    index: dict[str, list[tuple[str, dict[str, tuple[int, int]]]]]
+
+    def __init__(self, directory: str, concurrency: int = 1) -> None:
+        self.directory = utils.check_directory(directory)
+        self.destination = utils.check_directory(self.directory.joinpath('packs'), create=True)
+        self.concurrency = concurrency
+        if brotli is None:
+            _info('brotli not installed, skipping .br packs')
+        self.index = self.pack_all()
+
+    def _pack(self, name: str, files: list[str], stories: dict[str, str | dict[str, str]]):
+        content = bytearray()
+        offsets: dict[str, tuple[int, int]] = {}
+        for file in files:
+            entry = stories.get(file)
+            if entry is None:
+                _warning('story %s not found for pack %s', file, name)
+                continue
+            data = self.directory.joinpath(_story_path(entry)).read_bytes()
+            offsets[file] = (len(content), len(data))
+            content.extend(data)
+        path = self.destination.joinpath(f'{name}.pack')
+        path.write_bytes(content)
+        path.with_suffix('.pack.gz').write_bytes(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            path.with_suffix('.pack.br').write_bytes(brotli.compress(bytes(content), mode=brotli.MODE_TEXT))
+        return path.relative_to(self.directory).as_posix(), offsets
+
+    def pack_all(self):
+        with self.directory.joinpath('chapters.json').open(encoding='utf-8') as f:
+            all_chapters: dict[str, list[dict[str, typing.Any]]] = json.load(f)
+        with self.directory.joinpath('stories.json').open(encoding='utf-8') as f:
+            stories: dict[str, str | dict[str, str]] = json.load(f)
+        futures = {}
+        with workers.Workers(self.concurrency, 'pack') as pool:
+            for category, chapters in all_chapters.items():
+                futures[category] = [
+                    pool.submit(self._pack, f'{category}-{i}', _chapter_files(chapter), stories, label=f'{category}-{i}')
+                    for i, chapter in enumerate(chapters)
+                ]
+        return dict((category, [future.result() for future in packed]) for category, packed in futures.items())
+
+    def save(self):
+        path = self.directory.joinpath('packs.json')
+        with path.open('w', encoding='utf-8') as f:
+            f.write(json.dumps(self.index, ensure_ascii=False, separators=(',', ':')))
+        return path
@@ -0,0 +1,111 @@
+import concurrent.futures
+import dataclasses
+import logging
+import time
+import typing
+
+_logger = logging.getLogger('gfunpack.pipeline')
+_info = _logger.info
+
+
+@dataclasses.dataclass
+class Stage:
+    """
+    A unit of work in the unpacking pipeline.
+
+    ``inputs`` and ``outputs`` are artifact names (usually the json files a stage writes).
+    A stage starts once every stage producing one of its inputs has finished.
+    ``run`` receives the artifacts produced so far and may return in-memory artifacts by name.
+    """
+    name: str
+    run: typing.Callable[[dict[str, typing.Any]], dict[str, typing.Any] | None]
+    inputs: tuple[str, ...] = ()
+    outputs: tuple[str, ...] = ()
+
+
+class Pipeline:
+    stages: dict[str, Stage]
+
+    dependencies: dict[str, set[str]]
+
+    artifacts: dict[str, typing.Any]
+
+    timings: dict[str, float]
+
+    def __init__(self, stages: list[Stage]) -> None:
+        self.stages = {}
+        producers: dict[str, str] = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f'duplicate stage {stage.name}')
+            self.stages[stage.name] = stage
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f'{output} produced by both {producers[output]} and {stage.name}')
+                producers[output] = stage.name
+        self.dependencies = {}
+        for stage in stages:
+            missing = [i for i in stage.inputs if i not in producers]
+            if len(missing) > 0:
+                raise ValueError(f'no stage produces {missing} required by {stage.name}')
+            self.dependencies[stage.name] = set(producers[i] for i in stage.inputs)
+        self._check_cycles()
+        self.artifacts = {}
+        self.timings = {}
+
+    def _check_cycles(self):
+        remaining = dict((name, set(deps)) for name, deps in self.dependencies.items())
+        while len(remaining) > 0:
+            ready = [name for name, deps in remaining.items() if len(deps) == 0]
+            if len(ready) == 0:
+                raise ValueError(f'cyclic stage dependencies: {sorted(remaining)}')
+            for name in ready:
+                remaining.pop(name)
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def _run_stage(self, stage: Stage):
+        _info('stage %s started', stage.name)
+        start = time.perf_counter()
+        produced = stage.run(self.artifacts)
+        elapsed = time.perf_counter() - start
+        _info('stage %s finished in %.1fs', stage.name, elapsed)
+        if produced is not None:
+            unknown = produced.keys() - set(stage.outputs)
+            if len(unknown) > 0:
+                raise ValueError(f'stage {stage.name} produced undeclared artifacts {sorted(unknown)}')
+        return produced, elapsed
+
+    def run(self, concurrency: int | None = None):
+        """
+        Runs every stage as soon as its dependencies are done.
+
+        ``concurrency=1`` runs the stages one after another in dependency order.
+        The first failing stage stops scheduling; stages already running are waited for.
+        """
+        workers = len(self.stages) if concurrency is None else max(1, concurrency)
+        done: set[str] = set()
+        started: set[str] = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stage') as executor:
+            running: dict[concurrent.futures.Future, str] = {}
+            while len(done) < len(self.stages):
+                for name, stage in self.stages.items():
+                    if len(running) >= workers:
+                        break
+                    if name in started or not self.dependencies[name].issubset(done):
+                        continue
+                    started.add(name)
+                    running[executor.submit(self._run_stage, stage)] = name
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        concurrent.futures.wait(running)
+                        raise RuntimeError(f'stage {name} failed') from error
+                    produced, elapsed = future.result()
+                    if produced is not None:
+                        self.artifacts.update(produced)
+                    self.timings[name] = elapsed
+                    done.add(name)
+        return self.artifacts
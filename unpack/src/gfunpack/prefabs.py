@@ -1,14 +1,13 @@
+import contextlib
 import dataclasses
 import logging
 import pathlib
 import re
 import typing
 
-import UnityPy
-from UnityPy import Environment
 from UnityPy.classes import GameObject, MonoBehaviour, MonoScript
 
-from gfunpack import utils
+from gfunpack import bundles, utils
 
 _logger = logging.getLogger('gfunpack.prefabs')
 _warning = _logger.warning
@@ -37,16 +36,17 @@ class Prefabs:
     def __init__(self, directory: str) -> None:
         self.directory = utils.check_directory(directory)
         self.resource_files = list(self.directory.glob('*prefab*.ab'))
-        prefabs = [UnityPy.load(str(path)) for path in self.resource_files]
-        self.details = self.load_prefabs(prefabs)
+        with contextlib.ExitStack() as stack:
+            prefabs = [stack.enter_context(bundles.open_bundle(path)) for path in self.resource_files]
+            self.details = self.load_prefabs(prefabs)
 
-    def _collect_dialogue_pic_holders(self, prefabs: list[Environment]):
+    def _collect_dialogue_pic_holders(self, prefabs: list[bundles.Bundle]):
         objects: dict[int, MonoBehaviour] = {}
         for prefab in prefabs:
             for obj in prefab.objects:
                 if obj.type.name != 'MonoBehaviour':
                     continue
-                data = typing.cast(MonoBehaviour, obj.read())
+                data = typing.cast(MonoBehaviour, prefab.read(obj))
                 try:
                     script: MonoScript = data.m_Script.read()
                     if script.name == 'DialoguePicHolder':
@@ -64,12 +64,12 @@ class Prefabs:
         match = _path_regex.match(path)
         return None if match is None else match.group(1)
 
-    def _collect_game_objects(self, prefabs: list[Environment]):
+    def _collect_game_objects(self, prefabs: list[bundles.Bundle]):
         objects: dict[int, GameObject] = {}
         for prefab in prefabs:
-            for path, obj in prefab.container.items():
+            for path, obj in prefab.environment.container.items():
                 if obj.type.name == 'GameObject' and self._match_container_path(path) is not None:
-                    data = typing.cast(GameObject, obj.read())
+                    data = typing.cast(GameObject, prefab.read(obj))
                     if data.name is not None and data.name != '':
                         objects[data.path_id] = data
         return objects
@@ -111,7 +111,7 @@ class Prefabs:
             ))
         return details
 
-    def load_prefabs(self, prefabs: list[Environment]):
+    def load_prefabs(self, prefabs: list[bundles.Bundle]):
         dialogue_pics = self._collect_dialogue_pic_holders(prefabs)
         objects = self._collect_game_objects(prefabs)
         details: dict[str, list[DialoguePicDetails]] = {}
@@ -0,0 +1,117 @@
+import json
+import pathlib
+import re
+import unicodedata
+import zlib
+
+from gfunpack import utils
+
+_markup_regex = re.compile('<[^<>]*>')
+# CJK ideographs, kana and hangul are indexed as bigrams, everything else word by word
+_cjk_run_regex = re.compile('[\\u3040-\\u30ff\\u3400-\\u4dbf\\u4e00-\\u9fff\\uac00-\\ud7af\\uf900-\\ufaff]+')
+_word_regex = re.compile('\\w+')
+
+
+def normalize(text: str):
+    return unicodedata.normalize('NFKC', _markup_regex.sub('', text)).lower()
+
+
+def tokenize(text: str):
+    """
+    Splits text into search terms: overlapping bigrams for CJK runs (the character itself for a run of one),
+    and words for other scripts, e.g. Russian.
+
+    The viewer tokenizes queries the same way.
+    """
+    text = normalize(text)
+    terms: list[str] = []
+    position = 0
+    for run in _cjk_run_regex.finditer(text):
+        terms.extend(_word_regex.findall(text, position, run.start()))
+        chars = run.group(0)
+        if len(chars) == 1:
+            terms.append(chars)
+        else:
+            terms.extend(chars[i:i + 2] for i in range(len(chars) - 1))
+        position = run.end()
+    terms.extend(_word_regex.findall(text, position))
+    return terms
+
+
+def speaker_term(speaker: str):
+    return f'@{normalize(speaker).strip()}'
+
+
+def index_lines(lines: list[tuple[str, str]]):
+    """
+    Maps each term to the sorted numbers of the `(speaker, text)` lines containing it.
+    Speakers are indexed as whole `@name` terms.
+    """
+    terms: dict[str, list[int]] = {}
+    for number, (speaker, text) in enumerate(lines):
+        line_terms = set(tokenize(text))
+        if speaker.strip() != '':
+            line_terms.add(speaker_term(speaker))
+        for term in line_terms:
+            terms.setdefault(term, []).append(number)
+    return terms
+
+
+def shard_of(term: str, shards: int):
+    return zlib.crc32(term.encode('utf-8')) % shards
+
+
+class SearchIndex:
+    """
+    An inverted index over story lines, sharded by the CRC-32 of terms so that the viewer loads shards lazily.
+
+    Each shard maps terms to a flat integer array: for every story containing the term,
+    the story id delta, the number of lines, then the line number deltas.
+    """
+    stories: list[str]
+
+    terms: dict[str, list[tuple[int, list[int]]]]
+
+    shards: int
+
+    def __init__(self, shards: int = 64) -> None:
+        self.stories = []
+        self.terms = {}
+        self.shards = shards
+
+    def add(self, story: str, terms: dict[str, list[int]]):
+        story_id = len(self.stories)
+        self.stories.append(story)
+        for term, lines in terms.items():
+            self.terms.setdefault(term, []).append((story_id, lines))
+
+    @classmethod
+    def _encode(cls, postings: list[tuple[int, list[int]]]):
+        encoded: list[int] = []
+        last_story = 0
+        for story_id, lines in postings:
+            encoded.append(story_id - last_story)
+            encoded.append(len(lines))
+            last_line = 0
+            for line in lines:
+                encoded.append(line - last_line)
+                last_line = line
+            last_story = story_id
+        return encoded
+
+    def save(self, directory: pathlib.Path):
+        directory = utils.check_directory(directory, create=True)
+        shards: list[dict[str, list[int]]] = [{} for _ in range(self.shards)]
+        for term in sorted(self.terms):
+            shards[shard_of(term, self.shards)][term] = self._encode(self.terms[term])
+        for i, shard in enumerate(shards):
+            with directory.joinpath(f'{i}.json').open('w', encoding='utf-8') as f:
+                f.write(json.dumps(shard, ensure_ascii=False, separators=(',', ':')))
+        path = directory.joinpath('index.json')
+        with path.open('w', encoding='utf-8') as f:
+            f.write(json.dumps({
+                'shards': self.shards,
+                'hash': 'crc32',
+                'stories': self.stories,
+            }, ensure_ascii=False, separators=(',', ':')))
+        return path
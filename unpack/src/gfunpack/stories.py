@@ -1,41 +1,70 @@
+import codecs
+import dataclasses
+import hashlib
 import json
 import logging
-import os
 import pathlib
 import re
+import sqlite3
+import sys
 import typing
 
-import UnityPy
+import tqdm
 from UnityPy.classes import TextAsset
 
-from gfunpack import mapper, utils, manual_chapters
+from gfunpack import bundles, mapper, search, utils, workers, manual_chapters
 
 _logger = logging.getLogger('gfunpack.prefabs')
 _warning = _logger.warning
 
 _text_asset_regex = re.compile('^assets/resources/dabao/avgtxt/(.+.txt)$')
 
-_speaker_regex = re.compile('<speaker>(.*)</speaker>', re.IGNORECASE)
 _sprite_regex = re.compile('^([^()<>]*)\\((\\d*)\\)')
-_effect_tag_regex = re.compile('</?([^<>]+)>')
-_line_replace_templates = [
-    (
-        re.compile('[\x00-\x1f\x7f-\x9f]'),
-        ' ',
-    ),
-    (
-        re.compile('<color=(#\\w+)>', re.IGNORECASE),
-        lambda match: f'<span style="color: {match.group(1)}">',
-    ),
-    (
-        re.compile('<size=(\\d+)>', re.IGNORECASE),
-        lambda match: f'<span style="font-size: {int(match.group(1)) / 50}em">',
-    ),
-    (
-        re.compile('</size>|</color>', re.IGNORECASE),
-        '</span>',
-    )
-]
+_tag_regex = re.compile('<([^<>]+)>')
+_speaker_end_regex = re.compile('</speaker>', re.IGNORECASE)
+# one alternation for every content token, tried in this order at each `<`
+_content_token_regex = re.compile(
+    '<color=(#\\w+)>|<size=(\\d+)>|</(?:size|color)>|<([^<>]+)>',
+    re.IGNORECASE,
+)
+_control_characters = dict.fromkeys([*range(0x00, 0x20), *range(0x7f, 0xa0)], ' ')
+
+
+def _scan_tags(text: str):
+    """
+    Lexes `<tag>` and `</tag>` tokens in a single scan.
+
+    Returns the tag names in order of first appearance, and the first end of each `<tag>`
+    and the first start of each `</tag>`.
+    """
+    names: dict[str, None] = {}
+    opened: dict[str, int] = {}
+    closed: dict[str, int] = {}
+    for match in _tag_regex.finditer(text):
+        tag = match.group(1)
+        opened.setdefault(tag, match.end())
+        if tag.startswith('/') and len(tag) > 1:
+            tag = tag[1:]
+            closed.setdefault(tag, match.start())
+        names[tag] = None
+    return names, opened, closed
+
+
+def _find_speaker(narrator: str, opened: dict[str, int], closed: dict[str, int]):
+    """
+    Finds `<speaker>...</speaker>` (case-insensitive, up to the last closing tag) from the scanned tags.
+
+    Returns `(speaker, narrator without the speaker tags)`, or `None` if there is no speaker.
+    """
+    starts = [end - len(tag) - 2 for tag, end in opened.items() if tag.lower() == 'speaker']
+    if len(starts) == 0 or not any(tag.lower() == 'speaker' for tag in closed):
+        return None
+    start = min(starts)
+    content_start = start + len('<speaker>')
+    end = max((match.start() for match in _speaker_end_regex.finditer(narrator)), default=-1)
+    if end < content_start:
+        return None
+    return narrator[content_start:end], narrator[:start] + narrator[end + len('</speaker>'):]
 
 _va11_drinks = {
     # grep 'Id = ' gf-data-ch/asset/luapatch/collaboration/va11/openva11.lua | \
@@ -78,12 +107,26 @@ _sprite_effects = {
     '隐身': 'stealth',
 }
 
+# any change to the transpiler, or to the tokenizer of the cached search terms, invalidates cached stories
+_transpiler_version = hashlib.blake2b(
+    b''.join(pathlib.Path(module).read_bytes() for module in (__file__, search.__file__)),
+    digest_size=8,
+).hexdigest()
+
 
 class StoryResources:
     audio: dict[str, str]
     backgrounds: dict[str, str]
     characters: dict[str, dict[str, mapper.SpriteDetails]]
 
+    background_urls: dict[str, str]
+    """background → interned `/images/...` URL, for backgrounds with a path"""
+
+    sprite_infos: dict[tuple[str, str], dict[str, typing.Any]]
+    """(lower-cased character, sprite) → serialized sprite info, shared by all stories and never to be mutated"""
+
+    _sprites: dict[tuple[str, int], tuple[str, dict[str, typing.Any] | None]]
+
     def __init__(self, audio_json: pathlib.Path, background_json: pathlib.Path, character_json: pathlib.Path) -> None:
         # Исправлено: добавлено указание кодировки UTF-8 при чтении файлов
         with audio_json.open(encoding='utf-8') as f:
@@ -99,6 +142,52 @@ class StoryResources:
             for sprite_key, sprite_value in v.items():
                 character_dict[sprite_key] = mapper.SpriteDetails(**typing.cast(dict[str, typing.Any], sprite_value))
             self.characters[k.lower()] = character_dict
+        self._intern()
+
+    def _intern(self):
+        """
+        Precomputes the URLs and sprite info that every story would otherwise rebuild.
+        """
+        self.background_urls = dict(
+            (bg, sys.intern(f'/images/{path}')) for bg, path in self.backgrounds.items() if path != ''
+        )
+        self.sprite_infos = {}
+        for character, sprites in self.characters.items():
+            for sprite, details in sprites.items():
+                self.sprite_infos[(character, sprite)] = {
+                    'name': sprite,
+                    'url': sys.intern(f'/images/{details.path}'),
+                    'scale': -1,
+                    'center': (-1, -1),
+                }
+        self._sprites = {}
+
+    def sprite(self, character: str, sprite: int):
+        """
+        Returns the `characters` dependency key of a sprite as written in a story,
+        and its info from `sprite_infos` if it exists.
+        """
+        resolved = self._sprites.get((character, sprite))
+        if resolved is None:
+            name, number = _wrong_sprites.get(character, {}).get(sprite, (character, sprite))
+            name = name.lower()
+            resolved = (sys.intern(f'{name}/{number}'), self.sprite_infos.get((name, str(number))))
+            self._sprites[(character, sprite)] = resolved
+        return resolved
+
+    def lookup(self, kind: str, key: str) -> str | None:
+        """
+        Returns what a story sees for a dependency recorded by `StoryTranspiler`.
+        """
+        if kind == 'characters':
+            character, sprite = key.rsplit('/', 1)
+            details = self.characters.get(character, {}).get(sprite)
+            return None if details is None else str(details.path)
+        return typing.cast(dict[str, str], getattr(self, kind)).get(key)
+
+    def digest(self, dependencies: typing.Iterable[tuple[str, str]]):
+        entries = [(kind, key, self.lookup(kind, key)) for kind, key in sorted(dependencies)]
+        return hashlib.blake2b(json.dumps(entries, ensure_ascii=False).encode(), digest_size=16).hexdigest()
 
 
 class StoryTranspiler:
@@ -111,64 +200,102 @@ class StoryTranspiler:
 
     missing_audio: dict[str, set[str]]
 
+    dependencies: set[tuple[str, str]]
+    """`(kind, key)` of every `StoryResources` entry looked up"""
+
+    events: list[list[typing.Any]] | None
+    """typed events for the JSON IR, if requested"""
+
+    search_lines: list[tuple[str, str]] | None
+    """`(speaker, html)` of every dialogue line and option, for the search index if requested"""
+
+    asset_lines: dict[str, int]
+    """the dialogue line (numbered as in `search_lines`) before which each background or audio URL is first needed"""
+
     _markdown: list[str]
     _remote_narrators: set[str]
     _sprites: dict[str, dict[int, str]]
-    _resources: set[str]
+    _resources: dict[str, None]
+    """resource URLs in order of first use, so that the output does not depend on the string hash seed"""
     _classes: set[str]
-    _class_updates: set[str]
-
-    def __init__(self, resources: StoryResources, script: str, filename: str) -> None:
+    _class_updates: dict[str, None]
+    _last_sprites: list[typing.Any] | None
+    _character_info: list[dict[str, typing.Any]] | None
+    _sprite_lines: dict[tuple[str, int], int]
+    _line_number: int
+
+    def __init__(self, resources: StoryResources, script: str, filename: str, ir: bool = False,
+                 searchable: bool = False) -> None:
         self.external = resources
         self.script = script
         self.filename = filename
 
+        self.events = [] if ir else None
+        self.search_lines = [] if searchable else None
+        self._last_sprites = None
+        self._character_info = None
+        self._sprite_lines = {}
+        self._line_number = 0
+        self.asset_lines = {}
+
         self.effect_tags = set()
         self.content_tags = set()
 
         self.missing_audio = {}
 
+        self.dependencies = set()
+
         self._markdown = []
         self._remote_narrators = set()
         self._sprites = {}
-        self._resources = set()
+        self._resources = {}
         self._classes = set()
-        self._class_updates = set()
+        self._class_updates = {}
 
     def _update_class(self, c: str, state: bool):
         if state:
             self._classes.add(c)
-            self._class_updates.add(c)
+            self._class_updates[c] = None
         else:
             if c in self._classes:
                 self._classes.remove(c)
-                self._class_updates.add(f'!{c}')
+                self._class_updates[f'!{c}'] = None
+
+    def _convert_content_token(self, match: re.Match[str]):
+        color, size, tag = match.group(1, 2, 3)
+        if color is not None:
+            return f'<span style="color: {color}">'
+        if size is not None:
+            return f'<span style="font-size: {int(size) / 50}em">'
+        if tag is None:
+            return '</span>'
+        if tag.startswith('/') and len(tag) > 1:
+            tag = tag[1:]
+        if not tag.startswith('span'):
+            self.content_tags.add(tag.lower())
+        return match.group(0)
 
     def _convert_content_line(self, line: str):
-        for pattern, replacement in _line_replace_templates:
-            line = re.sub(pattern, replacement, line)
-        self.content_tags.update(
-            tag.lower()
-            for tag in re.findall(_effect_tag_regex, line)
-            if not tag.startswith('span')
-        )
-        return line
+        return _content_token_regex.sub(self._convert_content_token, line.translate(_control_characters))
 
-    def _convert_content(self, content: str, tags: str | None = None):
-        tags = '' if tags is None else f'{tags} '
-        return [
-            f'{tags}<p>{self._convert_content_line(line)}</p>'
-            for line in content.split('+')
-        ]
+    def _convert_content_lines(self, content: str):
+        return [self._convert_content_line(line) for line in content.split('+')]
+
+    def _emit(self, *event: typing.Any):
+        if self.events is not None:
+            self.events.append(list(event))
 
     def _parse_narrators(self, narrators: str):
         sprites: list[tuple[str, int, dict[str, str]]] = []
         speakers = []
         for narrator in narrators.split(';'):
-            match = re.search(_speaker_regex, narrator)
-            if match is not None:
-                speakers.append(match.group(1))
-                narrator = re.sub(_speaker_regex, '', narrator)
+            tags = _scan_tags(narrator)
+            speaker = _find_speaker(narrator, tags[1], tags[2])
+            if speaker is not None:
+                speakers.append(speaker[0])
+                narrator = speaker[1]
+                # removing the speaker may join pieces into new tags
+                tags = _scan_tags(narrator)
             sprite = _sprite_regex.match(narrator)
             if sprite is None:
                 _warning('unrecognized sprite `%s` in `%s`', narrator, narrators)
@@ -176,7 +303,7 @@ class StoryTranspiler:
             if sprite.group(1) == '' or sprite.group(2) == '':
                 sprites.append(('', 0, {}))
             else:
-                attrs = self._parse_effects(narrator)
+                attrs = self._parse_effects(narrator, tags)
                 name = sprite.group(1)
                 if '#' in name:
                     name, effect = name.split('#')
@@ -185,36 +312,29 @@ class StoryTranspiler:
                 sprites.append((name, int(sprite.group(2)), attrs))
         return sprites, speakers[-1] if len(speakers) > 0 else ''
 
-    def _parse_effects(self, effects: str):
-        tags = re.findall(_effect_tag_regex, effects)
-        parsed: dict[str, str] = dict((tag, '') for tag in tags)
+    def _parse_effects(self, effects: str, tags: tuple[dict[str, None], dict[str, int], dict[str, int]] | None = None):
+        names, opened, closed = _scan_tags(effects) if tags is None else tags
+        parsed: dict[str, str] = dict.fromkeys(names, '')
         for tag in parsed.keys():
-            if f'</{tag}>' in effects:
-                try:
-                    full_tag = f'<{tag}>'
-                    start = effects.index(full_tag)
-                    end = effects.index(f'</{tag}>')
-                    parsed[tag] = effects[start + len(full_tag): end]
-                except ValueError:
+            end = closed.get(tag)
+            if end is not None:
+                start = opened.get(tag)
+                if start is None:
                     _warning('tag %s wrong in `%s`', tag, effects)
+                else:
+                    parsed[tag] = effects[start:end]
         result = dict((k.lower(), v) for k, v in parsed.items())
         self.effect_tags.update(result.keys())
         return result
 
     def _get_sprite_info(self, character: str, sprite: int):
+        key, info = self.external.sprite(character, sprite)
+        self.dependencies.add(('characters', key))
+        if info is not None:
+            return info
         if character in _wrong_sprites:
             if sprite in _wrong_sprites[character]:
                 character, sprite = _wrong_sprites[character][sprite]
-        c = self.external.characters.get(character.lower())
-        if c is not None:
-            s = c.get(str(sprite))
-            if s is not None:
-                return {
-                    'name': str(sprite),
-                    'url': f'/images/{s.path}',
-                    'scale': -1,
-                    'center': (-1, -1),
-                }
         if character != '':
             _warning('sprite %s not found in %s', sprite, character)
         return {
@@ -224,7 +344,9 @@ class StoryTranspiler:
             'center': (-1, -1),
         }
 
-    def _inject_lua_scripts(self):
+    def _character_list(self):
+        if self._character_info is not None:
+            return self._character_info
         character_list = []
         for name, sprites in self._sprites.items():
             character_list.append({
@@ -234,6 +356,11 @@ class StoryTranspiler:
                     for sprite_name in sprites.keys()
                 ],
             })
+        self._character_info = character_list
+        return character_list
+
+    def _inject_lua_scripts(self):
+        character_list = self._character_list()
         serialized = json.dumps(json.dumps(character_list, ensure_ascii=False), ensure_ascii=False)
         resource_urls = json.dumps(json.dumps(
             list(self._resources), ensure_ascii=False), ensure_ascii=False)
@@ -245,14 +372,17 @@ extern.preloadResources({resource_urls})
     def _generate_bg_line(self, bg: str, effects: dict[str, str]):
         if bg == '':
             _warning('invalid bg in %s', self.filename)
-        bg_path = self.external.backgrounds.get(bg)
-        if bg_path is None or bg_path == '':
+        self.dependencies.add(('backgrounds', bg))
+        url = self.external.background_urls.get(bg)
+        if url is None:
             _warning('background not found for `%s` in %s', bg, self.filename)
-            bg_path = f'background/{bg}.png'
+            url = f'/images/background/{bg}.png'
         self._update_class('night', 'night' in effects)
         night = 'night' if 'night' in effects else '!night'
-        self._resources.add(f'/images/{bg_path}')
-        return f':background[] :classes[{night}] /images/{bg_path}'
+        self._resources[url] = None
+        self.asset_lines.setdefault(url, self._line_number)
+        self._emit('background', url, 'night' in effects)
+        return f':background[] :classes[{night}] {url}'
 
     def _split_line(self, line: str):
         # 大致行格式：
@@ -281,18 +411,24 @@ extern.preloadResources({resource_urls})
             self._update_class('blank', False)
             self._markdown.append(self._generate_bg_line(effects['bin'], effects))
         if 'bgm' in effects:
+            self.dependencies.add(('audio', effects['bgm']))
             if effects['bgm'] not in self.external.audio:
                 self.record_missing_audio('bgm', effects['bgm'])
             bgm = self.external.audio.get(effects['bgm'], f'bgm/{effects["bgm"]}.m4a')
-            self._resources.add(f'/audio/{bgm}')
+            self._resources[f'/audio/{bgm}'] = None
+            self.asset_lines.setdefault(f'/audio/{bgm}', self._line_number)
             self._markdown.append(f':audio[] /audio/{bgm}')
+            self._emit('bgm', f'/audio/{bgm}')
         if 'se' in effects or 'se1' in effects or 'se2' in effects or 'se3' in effects:
             se = effects.get('se') or effects.get('se1') or effects.get('se2') or effects.get('se3') or ''
+            self.dependencies.add(('audio', se))
             if se not in self.external.audio:
                 self.record_missing_audio('se', se)
             se = self.external.audio.get(se, f'se/{se}.m4a')
-            self._resources.add(f'/audio/{se}')
+            self._resources[f'/audio/{se}'] = None
+            self.asset_lines.setdefault(f'/audio/{se}', self._line_number)
             self._markdown.append(f':se[] /audio/{se}')
+            self._emit('se', f'/audio/{se}')
         if 'cg' in effects:
             self._update_class('blank', False)
             for i, cg in enumerate(effects['cg'].split(','), 1):
@@ -300,6 +436,7 @@ extern.preloadResources({resource_urls})
                     continue
                 self._markdown.append(self._generate_bg_line(cg.strip(), effects))
                 self._markdown.append('……' * i)
+                self._emit('text', '……' * i)
 
         # 一众的蒙版效果
         if '回忆' in effects:
@@ -327,6 +464,7 @@ extern.preloadResources({resource_urls})
             if character not in self._sprites:
                 self._sprites[character] = {}
             self._sprites[character][sprite] = ''
+            self._sprite_lines.setdefault((character, sprite), self._line_number)
         sprite_string = '|'.join(f'{character}/{sprite}/{",".join(effects.keys())}'
                                  for character, sprite, effects in sprites)
         self._remote_narrators = set(
@@ -337,6 +475,15 @@ extern.preloadResources({resource_urls})
             f'{character}/{sprite}' for character, sprite, _ in sprites
             if character in self._remote_narrators
         )
+        if self.events is not None:
+            # only changes of the sprites on stage are emitted
+            current = [
+                [[character, sprite, list(effects.keys())] for character, sprite, effects in sprites],
+                [[character, sprite] for character, sprite, _ in sprites if character in self._remote_narrators],
+            ]
+            if current != self._last_sprites:
+                self._emit('sprites', *current)
+                self._last_sprites = current
         return speaker, sprite_string, remote_string
 
     def _parse_va11(self, content: str):
@@ -358,7 +505,7 @@ extern.preloadResources({resource_urls})
             return None
 
         for line in self.script.split('\n'):
-            self._class_updates = set()
+            self._class_updates = {}
             segments = self._split_line(line)
             if segments is None:
                 continue
@@ -378,6 +525,7 @@ extern.preloadResources({resource_urls})
             if '<cg>' in content:
                 content = content.split('<cg>')[0]
                 self._markdown.append('`branch = 0`')
+                self._emit('branch', 0)
             elif '<c>' in content:
                 options = content.split('<c>')
                 content, options = options[0], options[1:]
@@ -400,15 +548,216 @@ extern.preloadResources({resource_urls})
 
             classes_string = '' if len(self._class_updates) == 0 else f':classes[{" ".join(self._class_updates)}] '
             tags = f'{branching}{classes_string}:sprites[{sprite_string}] :remote[{remote_string}] :narrator[{speaker}] :color[#fff]'
-            self._markdown.extend(self._convert_content(content, tags))
+            lines = self._convert_content_lines(content)
+            self._markdown.extend(f'{tags} <p>{line}</p>' for line in lines)
+            for line in lines:
+                self._emit('line', speaker, line, sorted(self._class_updates), effects.get('分支'))
+            if self.search_lines is not None:
+                self.search_lines.extend((speaker, line) for line in lines)
+            self._line_number += len(lines)
 
             if len(options) != 0:
-                for i, option in enumerate(options, 1):
-                    self._markdown.append(f'- {"".join(self._convert_content(option))}\n\n  `branch = {i}`')
+                converted = [''.join(f'<p>{line}</p>' for line in self._convert_content_lines(option))
+                             for option in options]
+                for i, option in enumerate(converted, 1):
+                    self._markdown.append(f'- {option}\n\n  `branch = {i}`')
+                self._emit('options', option_type, converted)
+                if self.search_lines is not None:
+                    self.search_lines.extend(('', option) for option in converted)
+                self._line_number += len(converted)
                 if option_type == 't':
                     self._markdown.append('`branch = 0`')
+                    self._emit('branch', 0)
         return self._inject_lua_scripts() + '\n\n'.join(self._markdown)
 
+    def prefetch_order(self):
+        """
+        `(url, line)` of every asset of the decoded story, ordered by the dialogue line first needing it.
+        """
+        lines = dict(self.asset_lines)
+        # the character list is built in the order of `_sprites`
+        for (name, sprites), character in zip(self._sprites.items(), self._character_list()):
+            for sprite, info in zip(sprites.keys(), character['sprites']):
+                line = self._sprite_lines[(name, sprite)]
+                if info['url'] != '':
+                    lines[info['url']] = min(line, lines.get(info['url'], line))
+        return sorted(lines.items(), key=lambda item: (item[1], item[0]))
+
+    def ir(self):
+        """
+        The JSON IR of the decoded story: the preloaded characters and resources, and the events in order.
+
+        Events are arrays starting with their type:
+        `background` (url, night), `bgm` (url), `se` (url), `text` (text),
+        `sprites` (`[name, sprite, effects]` on stage, `[name, sprite]` in remote frames, sent when changed),
+        `line` (speaker, html, class updates, branch condition), `options` (type, html of each option)
+        and `branch` (value).
+        """
+        assert self.events is not None
+        return json.dumps({
+            'characters': self._character_list(),
+            'resources': sorted(self._resources),
+            'events': self.events,
+        }, ensure_ascii=False, separators=(',', ':'))
+
+
+_byte_order_marks = (
+    # the UTF-8 BOM is kept in the text, as it always was
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+def _decode_script(data: bytes, encoding: str | None = None):
+    """
+    Decodes a script with its encoding from an earlier run, or detects it:
+    a BOM, then pure ASCII, then UTF-8, then GBK and GB18030 as used by older Chinese scripts.
+
+    Every attempt decodes the same buffer without copying it. Returns `(text, encoding)`.
+    """
+    view = memoryview(data)
+    if encoding is not None:
+        return str(view, encoding, 'replace'), encoding
+    for bom, encoding in _byte_order_marks:
+        if data.startswith(bom):
+            return str(view, encoding, 'replace'), encoding
+    if data.isascii():
+        return str(view, 'ascii'), 'ascii'
+    for encoding in ('utf-8', 'gbk'):
+        try:
+            return str(view, encoding), encoding
+        except UnicodeDecodeError:
+            pass
+    return str(view, 'gb18030', 'replace'), 'gb18030'
+
+
+@dataclasses.dataclass
+class Transpiled:
+    markdown: str
+    content_tags: set[str]
+    effect_tags: set[str]
+    missing_audio: dict[str, set[str]]
+    dependencies: set[tuple[str, str]]
+    ir: str | None = None
+    terms: dict[str, list[int]] | None = None
+    """search terms and the numbers of the lines containing them"""
+    assets: list[tuple[str, int]] = dataclasses.field(default_factory=list)
+    """see `StoryTranspiler.prefetch_order`"""
+    encoding: str = 'utf-8'
+    """the detected encoding of the script"""
+
+
+_worker_resources: StoryResources | None = None
+
+
+def _init_worker(resources: StoryResources):
+    # resources are pickled once per worker process instead of once per story
+    global _worker_resources
+    _worker_resources = resources
+
+
+def _transpile(data: bytes, filename: str, ir: bool = False, searchable: bool = False,
+               resources: StoryResources | None = None, encoding: str | None = None):
+    resources = _worker_resources if resources is None else resources
+    assert resources is not None
+    script, encoding = _decode_script(data, encoding)
+    transpiler = StoryTranspiler(resources, script=script, filename=filename, ir=ir, searchable=searchable)
+    markdown = transpiler.decode()
+    return Transpiled(
+        markdown or '',
+        transpiler.content_tags,
+        transpiler.effect_tags,
+        transpiler.missing_audio,
+        transpiler.dependencies,
+        transpiler.ir() if ir and markdown is not None else None,
+        None if transpiler.search_lines is None else search.index_lines(transpiler.search_lines),
+        transpiler.prefetch_order() if markdown is not None else [],
+        encoding,
+    )
+
+
+def _ir_path(path: pathlib.Path):
+    return path.with_suffix('.json')
+
+
+class _TranspileCache:
+    """
+    Tags and dependencies of transpiled stories, keyed by story name.
+
+    An entry is valid while the script bytes, the transpiler and every `StoryResources` entry
+    the story looked up are unchanged.
+    """
+    db: sqlite3.Connection
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS story ('
+                        'name TEXT PRIMARY KEY,'
+                        'script TEXT,'
+                        'version TEXT,'
+                        'dependencies TEXT,'
+                        'resources TEXT,'
+                        'tags TEXT,'
+                        'terms TEXT,'
+                        'assets TEXT,'
+                        'encoding TEXT'
+                        ')')
+        columns = set(row[1] for row in self.db.execute('PRAGMA table_info(story)').fetchall())
+        for column in ('terms', 'assets', 'encoding'):
+            if column not in columns:
+                # caches from older versions: their stories lack the column and get transpiled once more
+                self.db.execute(f'ALTER TABLE story ADD COLUMN {column} TEXT')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def get(self, name: str, script: str, resources: StoryResources, searchable: bool = False) -> Transpiled | None:
+        row = self.db.execute('SELECT dependencies, resources, tags, terms, assets FROM story '
+                              'WHERE name = ? AND script = ? AND version = ?',
+                              (name, script, _transpiler_version)).fetchone()
+        if row is None or row[4] is None or (searchable and row[3] is None):
+            return None
+        dependencies = set((kind, key) for kind, key in json.loads(row[0]))
+        if resources.digest(dependencies) != row[1]:
+            return None
+        content_tags, effect_tags, missing_audio = json.loads(row[2])
+        return Transpiled('', set(content_tags), set(effect_tags),
+                          dict((k, set(v)) for k, v in missing_audio.items()), dependencies,
+                          terms=None if row[3] is None else json.loads(row[3]),
+                          assets=[(url, line) for url, line in json.loads(row[4])])
+
+    def encoding(self, name: str, script: str) -> str | None:
+        """
+        The encoding detected when the same script was last transpiled, even if the entry is otherwise stale.
+        """
+        row = self.db.execute('SELECT encoding FROM story WHERE name = ? AND script = ?', (name, script)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, name: str, script: str, resources: StoryResources, transpiled: Transpiled):
+        tags = [
+            sorted(transpiled.content_tags),
+            sorted(transpiled.effect_tags),
+            dict((k, sorted(v)) for k, v in transpiled.missing_audio.items()),
+        ]
+        self.db.execute('INSERT OR REPLACE INTO story '
+                        '(name, script, version, dependencies, resources, tags, terms, assets, encoding) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                            name,
+                            script,
+                            _transpiler_version,
+                            json.dumps(sorted(transpiled.dependencies), ensure_ascii=False),
+                            resources.digest(transpiled.dependencies),
+                            json.dumps(tags, ensure_ascii=False),
+                            None if transpiled.terms is None else json.dumps(transpiled.terms, ensure_ascii=False),
+                            json.dumps(transpiled.assets, ensure_ascii=False),
+                            transpiled.encoding,
+                        ))
+
+    def commit(self):
+        self.db.commit()
+
 
 class Stories:
     directory: pathlib.Path
@@ -427,8 +776,24 @@ class Stories:
 
     missing_audio: dict[str, set[str]]
 
+    concurrency: int
+
+    cache: _TranspileCache | None
+
+    transpiled: int
+    """stories transpiled in this run, i.e. not restored from the cache"""
+
+    ir: bool
+    """whether to write the JSON IR of every story next to its markdown"""
+
+    search_index: search.SearchIndex | None
+
+    assets: dict[str, list[tuple[str, int]]]
+    """prefetch order of every story, see `StoryTranspiler.prefetch_order`"""
+
     def __init__(self, directory: str, destination: str, *, gf_data_directory: str | None = None,
-                 root_destination: str | None = None):
+                 root_destination: str | None = None, concurrency: int = 1, incremental: bool = True,
+                 ir: bool = False, searchable: bool = False):
         self.directory = utils.check_directory(directory)
         self.destination = utils.check_directory(destination, create=True)
         self.resource_file = self.directory.joinpath('asset_textavg.ab')
@@ -443,50 +808,101 @@ class Stories:
         self.content_tags = set()
         self.effect_tags = set()
         self.missing_audio = {'bgm': set(), 'se': set()}
-        self.extracted = self.extract_all()
-        self.copy_missing_pieces()
+        self.concurrency = concurrency
+        self.ir = ir
+        self.search_index = search.SearchIndex() if searchable else None
+        self.assets = {}
+        self.cache = _TranspileCache(root.joinpath('transpile-cache.db')) if incremental else None
+        self.transpiled = 0
+        try:
+            self.extracted = self.extract_all()
+            self.copy_missing_pieces()
+        finally:
+            if self.cache is not None:
+                self.cache.close()
         _warning('missing audio: %s', self.missing_audio)
 
-    def _decode(self, content: str, filename: str):
-        transpiler = StoryTranspiler(self.resources, script=content, filename=filename)
-        chunk = transpiler.decode()
-        self.content_tags.update(transpiler.content_tags)
-        self.effect_tags.update(transpiler.effect_tags)
-        for k, v in transpiler.missing_audio.items():
+    def _merge(self, name: str, transpiled: Transpiled):
+        if self.search_index is not None and transpiled.terms is not None:
+            self.search_index.add(name, transpiled.terms)
+        self.assets[name] = transpiled.assets
+        self.content_tags.update(transpiled.content_tags)
+        self.effect_tags.update(transpiled.effect_tags)
+        for k, v in transpiled.missing_audio.items():
             if k in self.missing_audio:
                 self.missing_audio[k].update(v)
-        return chunk
+
+    def _transpile_all(self, stories: list[tuple[str, bytes, pathlib.Path]]):
+        """
+        Transpiles `(name, raw bytes, output path)` stories, across processes if `concurrency` allows,
+        and merges their tags in input order.
+
+        Stories whose script and looked-up resources are unchanged since the last run are restored from the cache.
+        """
+        results: list[Transpiled | None] = [None] * len(stories)
+        hashes = [hashlib.blake2b(data, digest_size=16).hexdigest() for _, data, _ in stories]
+        if self.cache is not None:
+            for i, (name, _, path) in enumerate(stories):
+                if path.is_file() and (not self.ir or _ir_path(path).is_file()):
+                    results[i] = self.cache.get(name, hashes[i], self.resources, self.search_index is not None)
+        pending = [i for i, result in enumerate(results) if result is None]
+        encodings = [None if self.cache is None else self.cache.encoding(stories[i][0], hashes[i]) for i in pending]
+        scripts = [(stories[i][0], stories[i][1], encoding) for i, encoding in zip(pending, encodings)]
+        for i, transpiled in zip(pending, self._transpile_scripts(scripts)):
+            name, _, path = stories[i]
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open('w', encoding='utf-8') as f:
+                f.write(transpiled.markdown)
+            if transpiled.ir is not None:
+                with _ir_path(path).open('w', encoding='utf-8') as f:
+                    f.write(transpiled.ir)
+            if self.cache is not None:
+                self.cache.put(name, hashes[i], self.resources, transpiled)
+            results[i] = transpiled
+        if self.cache is not None:
+            self.cache.commit()
+        self.transpiled += len(pending)
+        for (name, _, _), result in zip(stories, results):
+            assert result is not None
+            self._merge(name, result)
+
+    def _transpile_scripts(self, scripts: list[tuple[str, bytes, str | None]]):
+        """
+        Transpiles `(name, raw bytes, known encoding or None)` scripts.
+        """
+        searchable = self.search_index is not None
+        if self.concurrency <= 1 or len(scripts) <= 1:
+            return [
+                _transpile(data, name, self.ir, searchable, self.resources, encoding)
+                for name, data, encoding in tqdm.tqdm(scripts)
+            ]
+        return workers.process_map(
+            _transpile,
+            [(data, name, self.ir, searchable, None, encoding) for name, data, encoding in scripts],
+            self.concurrency,
+            cost=lambda item: len(item[0]),
+            initializer=_init_worker,
+            initargs=(self.resources,),
+        )
 
     def extract_all(self):
-        assets = UnityPy.load(str(self.resource_file))
         extracted: dict[str, pathlib.Path] = {}
-        for o in assets.objects:
-            if o.container is None or o.type.name != 'TextAsset':
-                continue
-            match = _text_asset_regex.match(o.container)
-            if match is None:
-                continue
-            name = match.group(1)
-            text = typing.cast(
-                TextAsset,
-                o.read(),
-            )
-            # Пробуем разные кодировки для китайских текстов
-            try:
-                content = text.m_Script.tobytes().decode('utf-8')
-            except UnicodeDecodeError:
-                try:
-                    # Попробуем GBK, часто используется в китайских играх
-                    content = text.m_Script.tobytes().decode('gbk')
-                except UnicodeDecodeError:
-                    # Если не сработает, попробуем GB18030
-                    content = text.m_Script.tobytes().decode('gb18030', errors='replace')
-
-            path = self.destination.joinpath(*name.split('/'))
-            os.makedirs(path.parent, exist_ok=True)
-            with path.open('w', encoding='utf-8') as f:
-                decoded_content = self._decode(content, name) or ''
-                f.write(decoded_content)
+        scripts: list[tuple[str, bytes]] = []
+        with bundles.open_bundle(self.resource_file) as assets:
+            for o in assets.objects:
+                if o.container is None or o.type.name != 'TextAsset':
+                    continue
+                match = _text_asset_regex.match(o.container)
+                if match is None:
+                    continue
+                text = typing.cast(
+                    TextAsset,
+                    assets.read(o),
+                )
+                scripts.append((match.group(1), text.m_Script.tobytes()))
+        stories = [(name, data, self.destination.joinpath(*name.split('/'))) for name, data in scripts]
+        self._transpile_all(stories)
+        for name, _, path in stories:
             extracted[name] = path
         return extracted
 
@@ -494,31 +910,58 @@ class Stories:
         manual_chapters.get_extra_stories(self.gf_data_directory.joinpath('asset', 'avgtxt'))
         manual_chapters.get_extra_anniversary_stories(self.gf_data_directory.joinpath('asset', 'avgtxt'))
         directory = utils.check_directory(self.gf_data_directory.joinpath('asset', 'avgtxt'))
+        missing: list[pathlib.Path] = []
         for file in directory.glob('**/*.txt'):
-            rel = file.relative_to(directory)
-            name = str(rel)
+            name = str(file.relative_to(directory))
             if name not in self.extracted:
                 _warning('filling in %s', name)
-                path = self.destination.joinpath(rel)
-                path.parent.mkdir(exist_ok=True)
-                with path.open('w', encoding='utf-8') as f:
-                    # Пробуем разные кодировки для ручных глав
-                    try:
-                        content = file.read_text(encoding='utf-8')
-                    except UnicodeDecodeError:
-                        try:
-                            content = file.read_text(encoding='gbk')
-                        except UnicodeDecodeError:
-                            content = file.read_text(encoding='gb18030', errors='replace')
-
-                    decoded_content = self._decode(content, name) or ''
-                    f.write(decoded_content)
-                self.extracted[name] = path
+                missing.append(file)
+        stories = [
+            (str(file.relative_to(directory)), file.read_bytes(), self.destination.joinpath(file.relative_to(directory)))
+            for file in missing
+        ]
+        self._transpile_all(stories)
+        for name, _, path in stories:
+            self.extracted[name] = path
 
     def save(self):
+        """
+        Writes `stories.json`, mapping story names to markdown paths,
+        or to `{"path": markdown path, "ir": IR path}` when the IR is written.
+        """
         path = self.destination.joinpath('stories.json')
+        index: dict[str, typing.Any] = {}
+        for k, p in self.extracted.items():
+            if self.ir and _ir_path(p).is_file():
+                index[k] = {'path': p.relative_to(self.destination).as_posix(),
+                            'ir': _ir_path(p).relative_to(self.destination).as_posix()}
+            else:
+                index[k] = str(p.relative_to(self.destination))
+        with path.open('w', encoding='utf-8') as f:
+            f.write(json.dumps(index, ensure_ascii=False))
+        if self.search_index is not None:
+            self.search_index.save(self.destination.joinpath('search'))
+        self.save_assets()
+
+    def asset_ids(self):
+        return dict((url, i) for i, url in enumerate(sorted(set(
+            url for assets in self.assets.values() for url, _ in assets
+        ))))
+
+    def save_assets(self):
+        """
+        Writes `assets.json`, the story → asset graph: asset URLs, and for every story
+        a flat `[asset id, first line, ...]` array in prefetch order.
+        """
+        ids = self.asset_ids()
+        graph = {
+            'assets': list(ids.keys()),
+            'stories': dict(
+                (name, [n for url, line in self.assets[name] for n in (ids[url], line)])
+                for name in self.extracted.keys() if name in self.assets
+            ),
+        }
+        path = self.destination.joinpath('assets.json')
         with path.open('w', encoding='utf-8') as f:
-            f.write(json.dumps(
-                dict((k, str(p.relative_to(self.destination))) for k, p in self.extracted.items()),
-                ensure_ascii=False,
-            ))
\ No newline at end of file
+            f.write(json.dumps(graph, ensure_ascii=False, separators=(',', ':')))
+        return path
\ No newline at end of file
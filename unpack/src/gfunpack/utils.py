@@ -1,12 +1,23 @@
+import contextlib
+import ctypes
 import logging
 import os
 import pathlib
 import subprocess
+import sys
+import threading
 import typing
 
-import UnityPy
+from PIL import Image, features
 from UnityPy.classes import TextAsset
 
+from gfunpack import bundles, workers
+
+try:
+    import imagequant
+except ImportError:
+    imagequant = None
+
 _logger = logging.getLogger('gfunpack.utils')
 _warning = _logger.warning
 
@@ -40,13 +51,161 @@ def pngquant(image_path: pathlib.Path, use_pngquant: bool):
         os.replace(quant_path, image_path)
 
 
+def _pngquant_files(image_paths: list[pathlib.Path]):
+    # one process for the whole chunk, then move the results back in place
+    subprocess.run(['pngquant', '--ext', '.fs8.png', '--strip', '--force'] + image_paths).check_returncode()
+    for image_path in image_paths:
+        os.replace(image_path.with_suffix('.fs8.png'), image_path)
+
+
+class PngquantBatch:
+    """
+    Collects written PNGs and quantizes them with one `pngquant` process per chunk.
+
+    A chunk is sent to the worker pool once it reaches `max_files` files or `max_bytes` bytes;
+    the rest goes on `close` (or on leaving the `with` block).
+    """
+    max_files: int
+
+    max_bytes: int
+
+    _pending: list[pathlib.Path]
+
+    _pending_bytes: int
+
+    _workers: workers.Workers
+
+    _lock: threading.Lock
+
+    def __init__(self, concurrency: int, max_files: int = 64, max_bytes: int = 32 << 20) -> None:
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._pending = []
+        self._pending_bytes = 0
+        self._workers = workers.Workers(concurrency, 'pngquant')
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._workers.__exit__(exc_type, exc, tb)
+
+    def _take(self):
+        with self._lock:
+            chunk = self._pending
+            self._pending = []
+            self._pending_bytes = 0
+        return chunk
+
+    def add(self, image_path: pathlib.Path):
+        with self._lock:
+            self._pending.append(image_path)
+            self._pending_bytes += image_path.stat().st_size
+            full = len(self._pending) >= self.max_files or self._pending_bytes >= self.max_bytes
+        if full:
+            chunk = self._take()
+            if len(chunk) > 0:
+                self._workers.submit(_pngquant_files, chunk, label=str(chunk[0]))
+
+    def close(self):
+        chunk = self._take()
+        if len(chunk) > 0:
+            self._workers.submit(_pngquant_files, chunk, label=str(chunk[0]))
+        self._workers.join()
+
+
+@contextlib.contextmanager
+def pngquant_batch(quantization: str | None, concurrency: int) -> typing.Iterator[PngquantBatch | None]:
+    """
+    Yields a `PngquantBatch` if the CLI backend is in use, otherwise `None`.
+    """
+    if quantization != 'pngquant':
+        yield None
+        return
+    with PngquantBatch(concurrency) as batch:
+        yield batch
+
+
+def quantization_backend(use_pngquant: bool) -> str | None:
+    """
+    Picks how output PNGs get palette-quantized when `use_pngquant` is on.
+
+    `'pillow'` and `'imagequant'` run libimagequant in-process on the image before it is encoded,
+    `'pngquant'` runs the CLI on the written file, and `None` disables quantization.
+    """
+    if not use_pngquant:
+        return None
+    if features.check_feature('libimagequant'):
+        return 'pillow'
+    if imagequant is not None:
+        return 'imagequant'
+    return 'pngquant' if test_pngquant(True) else None
+
+
+def save_png(image: Image.Image, image_path: pathlib.Path, quantization: str | None,
+             batch: PngquantBatch | None = None):
+    """
+    Saves the image, palette-quantized with the backend from `quantization_backend`.
+
+    With the CLI backend, the file is handed to `batch` if given instead of spawning `pngquant` for it alone.
+    """
+    if quantization in ('pillow', 'imagequant'):
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        if quantization == 'pillow':
+            image = image.quantize(256, method=Image.Quantize.LIBIMAGEQUANT, dither=Image.Dither.FLOYDSTEINBERG)
+        else:
+            image = imagequant.quantize_pil_image(image, dithering_level=1.0, max_colors=256)
+    image.save(image_path)
+    if quantization == 'pngquant' and batch is not None:
+        batch.add(image_path)
+    else:
+        pngquant(image_path, use_pngquant=quantization == 'pngquant')
+
+
 def read_text_asset(bundle: pathlib.Path, container: str):
-    asset = UnityPy.load(str(bundle))
-    profile_reader = [o for o in asset.objects if o.container == container][0]
-    assert profile_reader.type.name == 'TextAsset'
-    profile = typing.cast(
-        TextAsset,
-        profile_reader.read(),
-    )
+    with bundles.open_bundle(bundle) as asset:
+        profile_reader = asset.find_container(container)
+        assert profile_reader.type.name == 'TextAsset'
+        profile = typing.cast(
+            TextAsset,
+            asset.read(profile_reader),
+        )
     content: str = profile.m_Script.tobytes().decode()
-    return content
\ No newline at end of file
+    return content
+
+
+def peak_rss_mb() -> float | None:
+    """
+    Peak resident set size of the current process in MiB, or `None` if the platform does not tell.
+
+    This is a high-water mark over the whole process lifetime: compare two readings to see what a step added.
+    """
+    if sys.platform == 'win32':
+        class Counters(ctypes.Structure):
+            _fields_ = [('cb', ctypes.c_uint32), ('PageFaultCount', ctypes.c_uint32)] + [
+                (name, ctypes.c_size_t) for name in (
+                    'PeakWorkingSetSize', 'WorkingSetSize',
+                    'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                    'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage',
+                    'PagefileUsage', 'PeakPagefileUsage',
+                )
+            ]
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        windll = getattr(ctypes, 'windll')
+        if not windll.psapi.GetProcessMemoryInfo(windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize / (1 << 20)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
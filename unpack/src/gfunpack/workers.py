@@ -0,0 +1,139 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import threading
+import time
+import typing
+
+import tqdm
+
+_logger = logging.getLogger('gfunpack.workers')
+_info = _logger.info
+
+T = typing.TypeVar('T')
+
+
+class Workers:
+    """
+    A thread pool for fanning out per-item work with a bounded number of tasks in flight.
+
+    `submit` blocks while `max_in_flight` tasks are queued or running. The first failure cancels the tasks
+    that have not started yet, and is raised from the next `submit` or from `join` (on leaving the
+    `with` block) as an `ExceptionGroup` holding every failure.
+    """
+    name: str
+
+    timings: dict[str, float]
+    """seconds spent on each labelled task"""
+
+    errors: list[BaseException]
+
+    _executor: concurrent.futures.ThreadPoolExecutor
+
+    _slots: threading.Semaphore
+
+    _futures: set[concurrent.futures.Future]
+
+    _lock: threading.Lock
+
+    def __init__(self, concurrency: int, name: str = 'worker', max_in_flight: int | None = None) -> None:
+        self.name = name
+        self.timings = {}
+        self.errors = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max(1, concurrency), thread_name_prefix=name)
+        self._slots = threading.Semaphore(max(1, concurrency * 2 if max_in_flight is None else max_in_flight))
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.join()
+        else:
+            self.cancel()
+            self._executor.shutdown(wait=True)
+
+    def _run(self, label: str | None, fn: typing.Callable[..., T], *args) -> T:
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            if label is not None:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.timings[label] = elapsed
+
+    def _done(self, future: concurrent.futures.Future):
+        if not future.cancelled():
+            error = future.exception()
+            if error is not None:
+                with self._lock:
+                    self.errors.append(error)
+                self.cancel()
+        with self._lock:
+            self._futures.discard(future)
+        # released last, so that a producer woken up by the slot sees the failure
+        self._slots.release()
+
+    def _raise_errors(self):
+        with self._lock:
+            errors = list(self.errors)
+        if len(errors) > 0:
+            raise ExceptionGroup(f'{len(errors)} {self.name} task(s) failed', errors)
+
+    def submit(self, fn: typing.Callable[..., T], *args, label: str | None = None) -> concurrent.futures.Future[T]:
+        self._raise_errors()
+        self._slots.acquire()
+        self._raise_errors()
+        future = self._executor.submit(self._run, label, fn, *args)
+        with self._lock:
+            self._futures.add(future)
+            failed = len(self.errors) > 0
+        future.add_done_callback(self._done)
+        if failed:
+            # a task failed after the check above, and its cancellation may have missed this one
+            future.cancel()
+        return future
+
+    def cancel(self):
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    def join(self):
+        """
+        Waits for every submitted task and raises the failures, if any.
+        """
+        with self._lock:
+            futures = list(self._futures)
+        concurrent.futures.wait(futures)
+        self._executor.shutdown(wait=True)
+        self._raise_errors()
+        if len(self.timings) > 0:
+            slowest = max(self.timings, key=lambda label: self.timings[label])
+            _info('%s: %d tasks, slowest %s (%.1fs)', self.name, len(self.timings), slowest, self.timings[slowest])
+
+
+def process_map(fn: typing.Callable[..., T], items: list[tuple], concurrency: int,
+                cost: typing.Callable[[tuple], int] | None = None,
+                initializer: typing.Callable[..., typing.Any] | None = None, initargs: tuple = ()) -> list[T]:
+    """
+    Calls `fn(*args)` for every `args` of `items` in worker processes, returning the results in order.
+
+    Items are submitted by decreasing `cost` so that no worker is left with a big one at the end.
+    `fn` and `initializer` must be module-level functions, picklable along with their arguments.
+    """
+    # other pipeline stages run in threads, which a forked worker could inherit mid-lock
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, concurrency),
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=initializer, initargs=initargs) as executor:
+        ordered = range(len(items)) if cost is None else sorted(
+            range(len(items)), key=lambda i: cost(items[i]), reverse=True)
+        futures = dict((executor.submit(fn, *items[i]), i) for i in ordered)
+        results: dict[int, T] = {}
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            results[futures[future]] = future.result()
+    return [results[i] for i in range(len(items))]
@@ -4,5 +4,27 @@ from gfunpack import audio
 def test_bgm():
     audio.BGM('downloader/output', 'audio')
 
+
+def test_loop_points():
+    metadata = audio._parse_vgmstream_metadata('''sample rate: 48000 Hz
+loop start: 24000 samples (0:00.500 seconds)
+loop end: 96000 samples (0:02.000 seconds)
+stream count: 3
+''')
+    assert audio._loop_points(metadata) == (0.5, 2.0)
+    assert audio._loop_points({'sample rate': '48000 Hz'}) is None
+
+
+def test_loudness_summary():
+    log = '''[Parsed_ebur128_0 @ 0x1] Summary:
+
+  Integrated loudness:
+    I:         -19.2 LUFS
+    Threshold: -29.3 LUFS
+'''
+    assert [float(i) for i in audio._loudness_pattern.findall(log)] == [-19.2]
+
 if __name__ == '__main__':
-    test_bgm()
\ No newline at end of file
+    test_bgm()
+    test_loop_points()
+    test_loudness_summary()
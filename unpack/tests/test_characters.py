@@ -1,4 +1,6 @@
-from gfunpack import characters, prefabs
+from PIL import Image
+
+from gfunpack import characters, database, prefabs
 
 
 def test_characters():
@@ -9,5 +11,37 @@ def test_characters():
     ).extract()
 
 
+def test_merge_quantized_alpha():
+    # a quantized alpha texture keeps its transparency in the palette (tRNS) rather than an alpha band
+    quantized = Image.new('P', (4, 4), 1)
+    quantized.putpalette([255, 255, 255, 255, 255, 255])
+    quantized.paste(0, (0, 0, 2, 4))
+    quantized.info['transparency'] = 0
+    merged = characters.CharacterCollection._merge_images(Image.new('RGB', (8, 8), (255, 0, 0)), quantized)
+    assert merged.getchannel('A').getextrema() == (0, 255)
+    assert merged.getchannel('A').getpixel((0, 0)) == 0
+
+
+def test_texture_pool_lookahead():
+    # textures 1-4 in bundle a, texture 1 and 4 far apart in the merge order
+    sources = dict((i, database.Image(i, f't{i}', 0, 2, 2, 'a' if i < 5 else 'b', '')) for i in range(1, 7))
+    uses = [[1, 5], [2, 5], [3, 6]] + [[6, 6]] * 10 + [[4, 6]]
+    reads: list[list[int]] = []
+
+    def read(infos: list[database.Image]):
+        reads.append(sorted(info.path_id for info in infos))
+        return dict((info.path_id, info) for info in infos)
+
+    pool = characters._TexturePool(sources, uses, read, None, lookahead=4)  # type: ignore
+    for path_ids in uses:
+        pool.acquire(path_ids)
+        pool.release(path_ids)
+    # texture 4 is read when needed rather than with the rest of its bundle
+    assert reads == [[1, 2, 3], [5, 6], [4]]
+    assert pool.textures == {} and pool.loaded_bytes == 0 and pool.pending == {}
+
+
 if __name__ == '__main__':
     test_characters()
+    test_merge_quantized_alpha()
+    test_texture_pool_lookahead()
@@ -1,9 +1,41 @@
-from gfunpack import database
+import tempfile
+import time
+from pathlib import Path
+
+import UnityPy
+
+from gfunpack import bundles, database
 
 def test_database():
     db = database.Database('test.db', 'downloader/output')
     db.get_all_images()
     db.close()
 
+def test_indexing_benchmark():
+    # per-bundle indexing time with full deserialization vs. header-only reads
+    for path in sorted(Path('downloader/output').glob('character_*.ab'))[:20]:
+        images = [o for o in UnityPy.load(str(path)).objects if o.type.name in ('Texture2D', 'Sprite')]
+        start = time.perf_counter()
+        for obj in images:
+            obj.read()
+        full = time.perf_counter() - start
+        start = time.perf_counter()
+        for obj in images:
+            bundles.peek_fields(obj, ('m_Name', 'm_Width', 'm_Height') if obj.type.name == 'Texture2D'
+                                else ('m_Name', 'm_Rect'))
+        peek = time.perf_counter() - start
+        print(f'{path.name}: {len(images)} images, read() {full * 1000:.1f} ms, peek {peek * 1000:.1f} ms')
+
+def test_fingerprint_truncated():
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory).joinpath('truncated.ab')
+        path.write_bytes(b'UnityFS\0\0\0\0\x065.x.x\0' + b'2017.4.40f1\0' + b'\0' * 6)
+        # hashed in full like other formats
+        before = bundles.fingerprint(path)
+        path.write_bytes(path.read_bytes() + b'\0')
+        assert bundles.fingerprint(path) != before
+
 if __name__ == '__main__':
     test_database()
+    test_indexing_benchmark()
+    test_fingerprint_truncated()
@@ -0,0 +1,10 @@
+from gfunpack import packs
+
+
+def test_packs():
+    story_packs = packs.StoryPacks('stories')
+    story_packs.save()
+
+
+if __name__ == '__main__':
+    test_packs()
@@ -0,0 +1,36 @@
+import threading
+
+from gfunpack import pipeline
+
+
+def test_pipeline():
+    order: list[str] = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(2, timeout=5)
+
+    def independent(name: str):
+        def run(_):
+            # both independent stages must be running at the same time
+            barrier.wait()
+            with lock:
+                order.append(name)
+            return {f'{name}.json': name}
+        return run
+
+    def dependent(artifacts):
+        order.append('c')
+        return {'c.json': artifacts['a.json'] + artifacts['b.json']}
+
+    stages = pipeline.Pipeline([
+        pipeline.Stage('c', dependent, inputs=('a.json', 'b.json'), outputs=('c.json',)),
+        pipeline.Stage('a', independent('a'), outputs=('a.json',)),
+        pipeline.Stage('b', independent('b'), outputs=('b.json',)),
+    ])
+    artifacts = stages.run()
+    assert order[-1] == 'c'
+    assert artifacts['c.json'] in ('ab', 'ba')
+    assert stages.timings.keys() == {'a', 'b', 'c'}
+
+
+if __name__ == '__main__':
+    test_pipeline()
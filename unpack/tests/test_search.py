@@ -0,0 +1,24 @@
+from gfunpack import search
+
+
+def test_tokenize():
+    assert search.tokenize('<span style="color: #fff">指挥官，</span>Привет, командир!') == [
+        '指挥', '挥官', 'привет', 'командир',
+    ]
+    assert search.index_lines([('M4A1', '指挥官'), ('', '指挥')]) == {
+        '指挥': [0, 1],
+        '挥官': [0],
+        '@m4a1': [0],
+    }
+
+
+def test_postings():
+    index = search.SearchIndex()
+    index.add('a.txt', {'指挥': [1, 4]})
+    index.add('b.txt', {'指挥': [2]})
+    assert index._encode(index.terms['指挥']) == [0, 2, 1, 3, 1, 1, 2]
+
+
+if __name__ == '__main__':
+    test_tokenize()
+    test_postings()
@@ -1,4 +1,15 @@
-from gfunpack import chapters, characters, mapper, prefabs, stories
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from pathlib import Path
+
+from UnityPy.classes import TextAsset
+
+from gfunpack import bundles, chapters, characters, mapper, prefabs, stories
 
 
 def test_stories():
@@ -9,5 +20,140 @@ def test_stories():
     print(ss.effect_tags)
 
 
+_benchmark_baselines = {
+    'before single-scan lexing': 'Lex story lines in a single scan per segment',
+    'before resource interning': 'Intern sprite info and background URLs in StoryResources',
+}
+"""earlier transpilers to compare against, by the subject of the commit that replaced them"""
+
+
+def _load_baseline(subject: str):
+    """
+    Loads stories.py as it was before the commit with the given subject, or `None` if git cannot tell.
+
+    `STORY_BENCHMARK_REF` names a revision to use instead.
+    """
+    src = Path(stories.__file__).parent
+    revision = os.environ.get('STORY_BENCHMARK_REF')
+    if revision is None:
+        log = subprocess.run(['git', 'log', '--format=%H', '--fixed-strings', f'--grep={subject}'],
+                             cwd=src, capture_output=True, text=True)
+        commits = log.stdout.split()
+        if log.returncode != 0 or len(commits) == 0:
+            return None
+        revision = f'{commits[-1]}^'
+    show = subprocess.run(['git', 'show', f'{revision}:./stories.py'], cwd=src, capture_output=True)
+    if show.returncode != 0:
+        return None
+    with tempfile.NamedTemporaryFile('wb', suffix='.py', delete=False) as f:
+        f.write(show.stdout)
+    name = f'gfunpack._stories_baseline_{len(sys.modules)}'
+    spec = importlib.util.spec_from_file_location(name, f.name)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    # dataclasses look their module up
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        os.unlink(f.name)
+    return module
+
+
+def _time_transpiler(module, scripts: list[tuple[str, str]], repeat: int = 3):
+    """
+    Best of `repeat` runs of the transpiler of the given stories module over `scripts`.
+    """
+    resources = module.StoryResources(Path('audio/audio.json'), Path('images/backgrounds.json'),
+                                      Path('images/characters.json'))
+    timings: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for name, script in scripts:
+            module.StoryTranspiler(resources, script, name).decode()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def test_transpile_benchmark():
+    # lines/second of StoryTranspiler over the whole avgtxt corpus, against earlier transpilers
+    scripts: list[tuple[str, str]] = []
+    with bundles.open_bundle('downloader/output/asset_textavg.ab') as assets:
+        for o in assets.objects:
+            if o.container is None or o.type.name != 'TextAsset':
+                continue
+            match = stories._text_asset_regex.match(o.container)
+            if match is not None:
+                text = typing.cast(TextAsset, assets.read(o))
+                scripts.append((match.group(1), text.m_Script.tobytes().decode('utf-8', errors='replace')))
+    lines = sum(script.count('\n') + 1 for _, script in scripts)
+    elapsed = _time_transpiler(stories, scripts)
+    print(f'{len(scripts)} scripts, {lines} lines in {elapsed:.2f}s: {lines / elapsed:.0f} lines/s, '
+          f'{elapsed / len(scripts) * 1e6:.0f} µs/story')
+    for label, subject in _benchmark_baselines.items():
+        baseline = _load_baseline(subject)
+        if baseline is None:
+            print(f'{label}: not found in git history')
+            continue
+        baseline_elapsed = _time_transpiler(baseline, scripts)
+        print(f'{label}: {baseline_elapsed:.2f}s, {lines / baseline_elapsed:.0f} lines/s, '
+              f'speedup {baseline_elapsed / elapsed:.2f}x')
+
+
+def test_sprite_interning():
+    resources = object.__new__(stories.StoryResources)
+    resources.audio = {}
+    resources.backgrounds = {'15': 'background/15.png', '16': ''}
+    resources.characters = {
+        'm4a1': {'3': mapper.SpriteDetails(path='pic/m4a1_3.png')},
+        'g36cmod': {'0': mapper.SpriteDetails(path='pic/g36cmod_0.png')},
+    }
+    resources._intern()
+    assert resources.background_urls == {'15': '/images/background/15.png'}
+    key, info = resources.sprite('M4A1', 3)
+    assert key == 'm4a1/3' and info is not None and info['url'] == '/images/pic/m4a1_3.png'
+    assert resources.sprite('M4A1', 3)[1] is info
+    assert resources.sprite('G36C', 7) == ('g36cmod/0', resources.sprite_infos[('g36cmod', '0')])
+    assert resources.sprite('M4A1', 4) == ('m4a1/4', None)
+
+
+def test_prefetch_order():
+    resources = object.__new__(stories.StoryResources)
+    resources.audio = {'GF_Battle': 'audio/battle.m4a'}
+    resources.backgrounds = {'15': 'background/15.png', '3': 'background/3.png'}
+    resources.characters = {'m4a1': {
+        '3': mapper.SpriteDetails(path='pic/m4a1_3.png'),
+        '4': mapper.SpriteDetails(path='pic/m4a1_4.png'),
+    }}
+    resources._intern()
+    transpiler = stories.StoryTranspiler(resources, '\n'.join([
+        'M4A1(3)<Speaker>M4A1</Speaker>||<BIN>15</BIN><BGM>GF_Battle</BGM>:一+二',
+        '()||:三<c>a<c>b',
+        'M4A1(4)||<BIN>3</BIN>:四',
+    ]), 'a.txt')
+    transpiler.decode()
+    assert transpiler.prefetch_order() == [
+        ('/audio/audio/battle.m4a', 0),
+        ('/images/background/15.png', 0),
+        ('/images/pic/m4a1_3.png', 0),
+        ('/images/background/3.png', 5),
+        ('/images/pic/m4a1_4.png', 5),
+    ]
+
+
+def test_decode_script():
+    assert stories._decode_script(b'()||:hi') == ('()||:hi', 'ascii')
+    assert stories._decode_script('()||:指挥官'.encode()) == ('()||:指挥官', 'utf-8')
+    assert stories._decode_script('()||:指挥官'.encode('gbk')) == ('()||:指挥官', 'gbk')
+    assert stories._decode_script('()||:𠀀'.encode('gb18030')) == ('()||:𠀀', 'gb18030')
+    assert stories._decode_script('()||:hi'.encode('utf-16')) == ('()||:hi', 'utf-16')
+    # a known encoding skips detection
+    assert stories._decode_script('指挥官'.encode('gbk'), 'gb18030') == ('指挥官', 'gb18030')
+
+
 if __name__ == '__main__':
-    test_stories()
\ No newline at end of file
+    test_stories()
+    test_transpile_benchmark()
+    test_prefetch_order()
+    test_sprite_interning()
+    test_decode_script()
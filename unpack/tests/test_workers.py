@@ -0,0 +1,81 @@
+import threading
+import time
+
+from gfunpack import workers
+
+
+def test_workers():
+    results: list[int] = []
+    lock = threading.Lock()
+
+    def square(i: int):
+        with lock:
+            results.append(i * i)
+
+    with workers.Workers(4, 'square') as pool:
+        for i in range(20):
+            pool.submit(square, i, label=str(i))
+    assert sorted(results) == [i * i for i in range(20)]
+    assert len(pool.timings) == 20
+
+
+def test_workers_failure():
+    def fail(i: int):
+        if i == 3:
+            raise ValueError(i)
+        time.sleep(0.01)
+
+    start = time.perf_counter()
+    try:
+        with workers.Workers(2, 'fail', max_in_flight=2) as pool:
+            for i in range(1000):
+                pool.submit(fail, i)
+    except ExceptionGroup as group:
+        assert [type(e) for e in group.exceptions] == [ValueError]
+    else:
+        assert False, 'failure not raised'
+    # the remaining tasks are neither submitted nor waited for
+    assert time.perf_counter() - start < 1
+
+
+class _YieldingSemaphore(threading.Semaphore):
+    # lets a waiting producer run as soon as a slot is released
+    def release(self, n: int = 1):
+        super().release(n)
+        time.sleep(0.01)
+
+
+def test_workers_failure_before_next_submit():
+    # the slot freed by a failed task is only released once its failure is recorded
+    started: list[int] = []
+
+    def fail(i: int):
+        started.append(i)
+        if i == 0:
+            # fails once the next submit is waiting for a slot
+            time.sleep(0.05)
+            raise ValueError(i)
+
+    try:
+        with workers.Workers(2, 'fail', max_in_flight=1) as pool:
+            pool._slots = _YieldingSemaphore(1)
+            for i in range(100):
+                pool.submit(fail, i)
+    except ExceptionGroup as group:
+        assert [type(e) for e in group.exceptions] == [ValueError]
+    else:
+        assert False, 'failure not raised'
+    assert started == [0]
+
+
+def test_process_map():
+    items = [(i, 2) for i in range(20)]
+    # submitted out of order, returned in order
+    assert workers.process_map(pow, items, 2, cost=lambda item: item[0] % 7) == [i * i for i in range(20)]
+
+
+if __name__ == '__main__':
+    test_workers()
+    test_workers_failure()
+    test_workers_failure_before_next_submit()
+    test_process_map()